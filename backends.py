@@ -0,0 +1,133 @@
+"""Prediction backends that can be driven a chunk of comments at a time.
+
+Each backend wraps one of the existing runners, without the file-based
+load/resume/finalize flow of its run_inference():
+
+- "gemma": gemma-base/local_model.py
+- "llama": llama-base/llama_inference_base.py
+- "gemini": gemma-base/run_inference.py (Gemini API)
+
+The runners import their helpers by bare module name, so the runner's
+folder is put on sys.path first. The local runners load their model at
+import, so a backend is expensive to create and cheap to call.
+"""
+import asyncio
+import importlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BACKENDS = {
+    "gemma": ("gemma-base", "local_model", "validate_schema"),
+    "llama": ("llama-base", "llama_inference_base", "llama_validate_schema"),
+    "gemini": ("gemma-base", "run_inference", "validate_schema"),
+}
+
+
+def import_runner(name, use_cache=True):
+    """Import a backend's runner and schema validator modules."""
+    folder, runner_name, validator_name = BACKENDS[name]
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    runner = importlib.import_module(runner_name)
+    validator = importlib.import_module(validator_name)
+    # Runner paths are relative to their own folder; keep sharing the same cache file
+    runner.PREDICTION_CACHE_PATH = os.path.join(path, runner.PREDICTION_CACHE_PATH)
+    if not use_cache:
+        runner.USE_PREDICTION_CACHE = False
+    return runner, validator
+
+
+def with_positions(entries):
+    """Copies of ``entries`` keyed by their position in the chunk.
+
+    Runners match results back to entries by comment_id, and callers' ids
+    can repeat within a chunk; a private per-chunk key cannot.
+    """
+    return [{**entry, "comment_id": i} for i, entry in enumerate(entries)]
+
+
+def restore_ids(entries, results):
+    """Put the callers' comment_ids back on results made from with_positions()."""
+    return [{**result, "id": entry["comment_id"]} for entry, result in zip(entries, results)]
+
+
+class LocalBackend:
+    """Predict chunks with a local runner's length-bucketed (or continuous) batching."""
+
+    def __init__(self, name, use_cache=True):
+        self.runner, self.validator = import_runner(name, use_cache)
+        self.verified = False
+
+    def predict(self, entries):
+        """Results for ``entries``, in order. Entries need "comment_id" and "text"."""
+        runner = self.runner
+        keyed = with_positions(entries)
+        results = runner.lookup_cached(keyed)
+        pending = [i for i in range(len(keyed)) if i not in results]
+        misses = [keyed[i] for i in pending]
+        if not misses:
+            return restore_ids(entries, [results[i] for i in range(len(keyed))])
+
+        if runner.PRETOKENIZED_PROMPTS and runner.VERIFY_PROMPT_SAMPLES and not self.verified:
+            runner.verify_prompt_assembly(misses[: runner.VERIFY_PROMPT_SAMPLES])
+            self.verified = True
+
+        if runner.CONTINUOUS_BATCHING:
+            results.update((result["id"], result) for result in runner.generate_continuous(misses))
+        else:
+            token_ids, batches = runner.schedule_batches(misses)
+            for batch in batches:
+                batch_results = runner.analyze_batch(
+                    [misses[j] for j in batch], [token_ids[j] for j in batch]
+                )
+                results.update((pending[j], result) for j, result in zip(batch, batch_results))
+        return restore_ids(entries, [results[i] for i in range(len(keyed))])
+
+    def validate(self, result):
+        return self.validator.validate_schema(result)
+
+    def close(self):
+        pass
+
+
+class ApiBackend:
+    """Predict chunks through the Gemini API runner on one long-lived event loop.
+
+    The scheduler (rate limits, AIMD state) and the HTTP connection pool
+    carry over from one chunk to the next.
+    """
+
+    def __init__(self, use_cache=True):
+        self.runner, self.validator = import_runner("gemini", use_cache)
+        self.loop = asyncio.new_event_loop()
+        self.scheduler = None
+
+    def predict(self, entries):
+        keyed = with_positions(entries)
+        results = {}
+
+        async def run():
+            if self.scheduler is None:
+                self.scheduler = self.runner.make_scheduler()
+            await self.runner.predict(
+                keyed, self.scheduler, lambda result: results.setdefault(result["id"], result)
+            )
+
+        self.loop.run_until_complete(run())
+        return restore_ids(entries, [results[i] for i in range(len(keyed))])
+
+    def validate(self, result):
+        return self.validator.validate_schema(result)
+
+    def close(self):
+        self.loop.run_until_complete(self.runner.close_client())
+        self.loop.close()
+
+
+def load_backend(name, use_cache=True):
+    """Create a backend; ``use_cache=False`` turns its runner's prediction cache off."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}; choose from {', '.join(BACKENDS)}")
+    return ApiBackend(use_cache) if name == "gemini" else LocalBackend(name, use_cache)
@@ -354,20 +354,63 @@ JSON SCHEMA (MUST MATCH EXACTLY)
 }}
 """
 
+# Compact response format: only the score, the 10 facets as a list and the
+# targets that are true. Far fewer output tokens than the full schema; the
+# inference side expands it back with expand_compact()/normalize_schema().
+COMPACT_OUTPUT = False
+
+COMPACT_INSTRUCTION = """
+You are an expert hate speech analyst. Your task is to analyze the provided text and return ONLY a compact JSON object in the format below.
+Do not include any explanations, markdown formatting, or text outside of the JSON object.
+
+=========================
+OUTPUT FORMAT
+=========================
+{"s": <hate_speech_score>, "f": [<10 facet integers>], "t": [<targeted groups>]}
+
+=========================
+FIELDS
+=========================
+"s" → float hate speech intensity:
+   - **Hateful content** → positive float > 0.5 (e.g., `0.8`, `1.52`, `2.3`)
+   - **Non-hateful content** → float <= 0.5 (e.g., `-0.8`, `0.12`, `-2.1`)
+
+"f" → exactly 10 integers 0-4 (0 = Absent, 1 = Mild, 2 = Clear, 3 = Severe, 4 = Extreme), in this order:
+   sentiment, respect, insult, humiliate, status, dehumanize, violence, genocide, attack_defend, hatespeech
+
+"t" → only the groups explicitly targeted in the text, named without the `target_` prefix (e.g. `"race_black"`, `"gender_women"`). Use `[]` if none.
+
+Example: {"s": 1.47, "f": [4, 4, 3, 3, 2, 1, 0, 0, 3, 3], "t": ["race_black"]}
+"""
+
+def to_compact(sample):
+    """Compact training target: score, ordered facet list and true targets only"""
+    return {
+        "s": sample["overall"]["hate_speech_score"],
+        "f": [sample["facets"][key] for key in FACET_COLUMNS],
+        "t": [key[len("target_"):] for key in TARGET_COLUMNS if sample["targets"].get(key)],
+    }
+
 """# THIS IS MEANT FOR LLAMA"""
 
 def create_conversation(sample):
-    system_msg = {"role": "system", "content": INSTRUCTION.strip()}
+    instruction = COMPACT_INSTRUCTION if COMPACT_OUTPUT else INSTRUCTION
+    system_msg = {"role": "system", "content": instruction.strip()}
 
     user_msg = {"role": "user", "content": sample["text"]}
 
-    assistant_msg = {
-        "role": "assistant",
-        "content": json.dumps({
+    if COMPACT_OUTPUT:
+        response = to_compact(sample)
+    else:
+        response = {
             "overall": sample["overall"],
             "facets": sample["facets"],
             "targets": sample["targets"],
-        }, ensure_ascii=False)
+        }
+
+    assistant_msg = {
+        "role": "assistant",
+        "content": json.dumps(response, ensure_ascii=False)
     }
 
     return {"messages": [system_msg, user_msg, assistant_msg]}
@@ -684,11 +727,29 @@ def derive_label_from_score(score: float) -> str:
     else:
         return "not_hateful"
 
+def expand_compact(data):
+    """Expand a compact {"s", "f", "t"} response into the nested schema"""
+    facets = data.get("f") if isinstance(data.get("f"), list) else []
+    true_targets = data.get("t") if isinstance(data.get("t"), list) else []
+    true_targets = {
+        name if name.startswith("target_") else f"target_{name}"
+        for name in true_targets
+        if isinstance(name, str)
+    }
+    return {
+        "overall": {"hate_speech_score": data.get("s", 0.0)},
+        "facets": dict(zip(FACET_COLUMNS, facets)),
+        "targets": {key: key in true_targets for key in TARGET_COLUMNS},
+    }
+
 def normalize_schema(data):
     """Normalize the JSON schema to ensure type consistency"""
     if isinstance(data, str):
         data = json.loads(data)
 
+    if "facets" not in data and any(key in data for key in ("s", "f", "t")):
+        data = expand_compact(data)
+
     overall = data.get("overall", {})
 
     if "hate_speech_score" not in overall and "score" in overall:
@@ -715,14 +776,65 @@ def normalize_schema(data):
 
     return data
 
+class JsonCloseLogitsProcessor:
+    """
+    vLLM logits processor that forces EOS once the top-level JSON object closes.
+    Tracks brace depth and string state over the new tokens only, so braces
+    inside string values do not count. Use one instance per request.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+        self.seen = 0
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+
+    def _feed(self, text):
+        for ch in text:
+            if self.closed:
+                return
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+
+    def __call__(self, output_token_ids, logits):
+        for token_id in output_token_ids[self.seen:]:
+            self._feed(self.tokenizer.decode([token_id], skip_special_tokens=True))
+        self.seen = len(output_token_ids)
+        if self.closed:
+            logits = torch.full_like(logits, float("-inf"))
+            logits[self.eos_token_id] = 0.0
+        return logits
+
 # ============================================================================
 # LORA MODEL MERGING
 # ============================================================================
 
-def merge_lora_model():
+def merge_lora_model(base_model_name="meta-llama/Llama-3.2-1B-Instruct",
+                     adapter_path="/content/llama3.2-1B-ctrl-alt-del-h8-r32",
+                     output_dir="llama-1B-merged-r32"):
     """
     Merges your LoRA adapter with the base Llama model.
-    Run this ONCE before using vLLM.
+    Run this ONCE before using vLLM. Pass the 3B base model and adapter to
+    build a verifier for run_inference_speculative().
     """
     print("="*60)
     print("STEP 1: Merging LoRA adapter with base Llama model")
@@ -730,7 +842,7 @@ def merge_lora_model():
 
     print("\n Loading base model...")
     base_model = AutoModelForCausalLM.from_pretrained(
-        "meta-llama/Llama-3.2-1B-Instruct",
+        base_model_name,
         torch_dtype=torch.bfloat16,
         device_map="auto"
     )
@@ -738,18 +850,17 @@ def merge_lora_model():
     print("\n Loading LoRA adapter...")
     model = PeftModel.from_pretrained(
         base_model,
-        "/content/llama3.2-1B-ctrl-alt-del-h8-r32"  # Your Llama LoRA checkpoint
+        adapter_path  # Your Llama LoRA checkpoint
     )
 
     print("\n Merging adapter with base model...")
     merged_model = model.merge_and_unload()
 
     print("\n Saving merged model...")
-    output_dir = "llama-1B-merged-r32"
     merged_model.save_pretrained(output_dir)
 
     # Also save the tokenizer
-    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.2-1B-Instruct")
+    tokenizer = AutoTokenizer.from_pretrained(base_model_name)
     tokenizer.save_pretrained(output_dir)
 
     print(f"\n Merged model saved to: {output_dir}")
@@ -759,6 +870,49 @@ def merge_lora_model():
 
 # !rm -rf llama-1B-merged-r32
 
+# ============================================================================
+# PREDICTION CACHE
+# ============================================================================
+# Same key scheme and table as gemma-base/prediction_cache.py, inlined so the
+# notebook runs on its own. Raw generations are stored, so cached samples go
+# through the same parsing as fresh ones.
+
+import hashlib
+import os
+import sqlite3
+import unicodedata
+
+USE_PREDICTION_CACHE = True
+PREDICTION_CACHE_PATH = "prediction_cache.sqlite"
+
+def hash_model_dir(path):
+    """Hash the weight, config and tokenizer files of a local model directory."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith((".safetensors", ".bin", ".json", ".model")):
+            continue
+        digest.update(name.encode("utf-8"))
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def open_prediction_cache(path=PREDICTION_CACHE_PATH):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS predictions "
+        "(key TEXT PRIMARY KEY, prediction TEXT NOT NULL)"
+    )
+    return conn
+
+def prediction_cache_key(namespace, text):
+    """sha256 of the configuration and the NFC, whitespace-collapsed text."""
+    text = " ".join(unicodedata.normalize("NFC", text).split())
+    payload = json.dumps(namespace, sort_keys=True) + "\0" + text
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
 # ============================================================================
 # VLLM INFERENCE
 # ============================================================================
@@ -788,12 +942,16 @@ def run_inference_vllm_merged(merged_model_path="llama-1B-merged-r32"):
         trust_remote_code=True,
     )
 
-    sampling_params = SamplingParams(
-        temperature=0.0,
-        max_tokens=4096,
-        stop=["<|eot_id|>", "</s>", "\n}\n", "}\n\n"],  # Llama stop tokens
-        stop_token_ids=[tokenizer.eos_token_id],
-    )
+    # String stops like "\n}\n" could cut the closing brace off or never match;
+    # the logits processor ends each request right after its JSON object closes
+    def make_sampling_params():
+        return SamplingParams(
+            temperature=0.0,
+            max_tokens=4096,
+            stop=["<|eot_id|>", "</s>"],  # Llama stop tokens
+            stop_token_ids=[tokenizer.eos_token_id],
+            logits_processors=[JsonCloseLogitsProcessor(tokenizer)],
+        )
 
     print("\n Loading test data...")
     test_data = load_dataset("json", data_files="test_aggregated.jsonl", split="train")
@@ -804,8 +962,9 @@ def run_inference_vllm_merged(merged_model_path="llama-1B-merged-r32"):
     prompts = []
     for sample in test_data:
         # Create messages in Llama format
+        instruction = COMPACT_INSTRUCTION if COMPACT_OUTPUT else INSTRUCTION
         messages = [
-            {"role": "system", "content": INSTRUCTION.strip()},
+            {"role": "system", "content": instruction.strip()},
             {"role": "user", "content": sample['text']}
         ]
 
@@ -819,16 +978,60 @@ def run_inference_vllm_merged(merged_model_path="llama-1B-merged-r32"):
     # Run inference
     print(f"\n Running inference on {len(prompts)} samples...")
 
-    outputs = llm.generate(prompts, sampling_params)
+    generated_texts = {}
+    if USE_PREDICTION_CACHE:
+        template = tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": (COMPACT_INSTRUCTION if COMPACT_OUTPUT else INSTRUCTION).strip()},
+                {"role": "user", "content": "{text}"},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        namespace = {
+            "model": "sha256:" + hash_model_dir(merged_model_path),
+            "tokenizer": "meta-llama/Llama-3.2-1B-Instruct",
+            "prompt": template,
+            "decoding": {
+                "backend": "vllm",
+                "temperature": 0.0,
+                "max_tokens": 4096,
+                "stop": ["<|eot_id|>", "</s>"],
+                "stop_on_json_close": True,
+            },
+        }
+        cache = open_prediction_cache()
+        keys = [prediction_cache_key(namespace, sample["text"]) for sample in test_data]
+        for i, key in enumerate(keys):
+            row = cache.execute(
+                "SELECT prediction FROM predictions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                generated_texts[i] = json.loads(row[0])
+        print(f" Prediction cache: {len(generated_texts)} of {len(prompts)} samples already generated")
+
+    misses = [i for i in range(len(prompts)) if i not in generated_texts]
+    if misses:
+        outputs = llm.generate(
+            [prompts[i] for i in misses], [make_sampling_params() for _ in misses]
+        )
+        for i, output in zip(misses, outputs):
+            generated_texts[i] = output.outputs[0].text.strip()
+        if USE_PREDICTION_CACHE:
+            cache.executemany(
+                "INSERT OR REPLACE INTO predictions (key, prediction) VALUES (?, ?)",
+                [(keys[i], json.dumps(generated_texts[i])) for i in misses],
+            )
+            cache.commit()
 
     # Process results
     print("\n Processing results...")
     predictions = []
     failed_samples = []
 
-    for i, output in enumerate(tqdm(outputs, desc="Processing outputs")):
+    for i in tqdm(range(len(prompts)), desc="Processing outputs"):
         sample = test_data[i]
-        generated_text = output.outputs[0].text.strip()
+        generated_text = generated_texts[i]
 
         try:
             predicted_json_str = extract_outer_json(generated_text)
@@ -875,12 +1078,190 @@ def run_inference_vllm_merged(merged_model_path="llama-1B-merged-r32"):
 
     return predictions
 
+# ============================================================================
+# SPECULATIVE DECODING (MERGED 1B DRAFT -> LARGER MERGED VERIFIER, CPU)
+# ============================================================================
+
+import time
+from transformers import DynamicCache
+
+# Keys that open each field group, full and compact schema
+FIELD_GROUPS = {
+    "overall": ('"overall"', '"s"'),
+    "facets": ('"facets"', '"f"'),
+    "targets": ('"targets"', '"t"'),
+}
+
+def field_group(text):
+    """The field group the output is in, judged by the last group key so far."""
+    group, position = "preamble", -1
+    for name, keys in FIELD_GROUPS.items():
+        found = max(text.rfind(key) for key in keys)
+        if found > position:
+            group, position = name, found
+    return group
+
+class AcceptanceStats:
+    """Drafted and accepted token counts per field group."""
+    def __init__(self):
+        self.drafted = {}
+        self.accepted = {}
+        self.rounds = 0
+
+    def record(self, group, accepted):
+        self.drafted[group] = self.drafted.get(group, 0) + 1
+        self.accepted[group] = self.accepted.get(group, 0) + int(accepted)
+
+    def report(self):
+        lines = ["Draft acceptance by field group:"]
+        for group in ["preamble", *FIELD_GROUPS]:
+            drafted = self.drafted.get(group, 0)
+            if drafted:
+                accepted = self.accepted[group]
+                lines.append(f"   {group:<9} {accepted}/{drafted} accepted ({accepted / drafted:.1%})")
+        total = sum(self.accepted.values())
+        lines.append(f"   Mean tokens accepted per verify pass: {total / max(self.rounds, 1):.2f}")
+        return "\n".join(lines)
+
+@torch.no_grad()
+def speculative_generate(draft_model, target_model, tokenizer, input_ids, stats,
+                         num_draft_tokens=6, max_new_tokens=1024):
+    """
+    Greedy decoding with target_model, drafted by draft_model.
+    The draft proposes up to num_draft_tokens tokens, the target scores them
+    all in one forward pass and keeps the prefix it agrees with plus its own
+    next token, so the output is exactly the target's greedy output. Stops
+    at EOS or once the top-level JSON object closes.
+    """
+    prompt_length = len(input_ids)
+    tokens = list(input_ids)
+    draft_cache, target_cache = DynamicCache(), DynamicCache()
+    stop_ids = {tokenizer.eos_token_id, tokenizer.convert_tokens_to_ids("<|eot_id|>")}
+    closer = JsonCloseLogitsProcessor(tokenizer)  # Only its brace tracking is used
+    text = ""
+
+    while len(tokens) - prompt_length < max_new_tokens:
+        # Draft greedily, feeding whatever the draft cache has not seen yet
+        drafted = []
+        feed = tokens[draft_cache.get_seq_length():]
+        for _ in range(num_draft_tokens):
+            logits = draft_model(
+                torch.tensor([feed]), past_key_values=draft_cache, use_cache=True
+            ).logits[0, -1]
+            feed = [int(logits.argmax())]
+            drafted.append(feed[0])
+            if feed[0] in stop_ids:
+                break
+
+        # Verify every drafted token in a single target forward pass
+        verify = tokens[target_cache.get_seq_length():] + drafted
+        logits = target_model(
+            torch.tensor([verify]), past_key_values=target_cache, use_cache=True
+        ).logits[0]
+        predicted = logits[-len(drafted) - 1:].argmax(-1).tolist()
+
+        accepted = 0
+        while accepted < len(drafted) and drafted[accepted] == predicted[accepted]:
+            accepted += 1
+        stats.rounds += 1
+
+        for i, token_id in enumerate(drafted[:accepted] + [predicted[accepted]]):
+            if i < len(drafted):
+                # Draft tokens up to the first mismatch were judged by the target
+                stats.record(field_group(text), i < accepted)
+            if token_id in stop_ids:
+                return tokens[prompt_length:]
+            tokens.append(token_id)
+            piece = tokenizer.decode([token_id], skip_special_tokens=True)
+            text += piece
+            closer._feed(piece)
+            if closer.closed:
+                return tokens[prompt_length:]
+
+        # Drop rejected tokens; the newest token is fed on the next round
+        target_cache.crop(len(tokens) - 1)
+        draft_cache.crop(min(draft_cache.get_seq_length(), len(tokens) - 1))
+
+    return tokens[prompt_length:]
+
+def run_inference_speculative(draft_model_path="llama-1B-merged-r32",
+                              target_model_path="llama-3B-merged-r32",
+                              num_draft_tokens=6,
+                              output_file="llama_test_predictions_speculative.jsonl"):
+    """
+    CPU inference where a merged 1B fine-tune drafts for a larger merged
+    fine-tune. Both must share the Llama 3 vocabulary. Writes the same
+    records as run_inference_vllm_merged and prints acceptance per field group.
+    """
+    print("\n" + "="*60)
+    print("SPECULATIVE INFERENCE (DRAFT -> VERIFIER, CPU)")
+    print("="*60)
+
+    tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-3.2-1B-Instruct")
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_model_path, torch_dtype=torch.float32).eval()
+    target_model = AutoModelForCausalLM.from_pretrained(target_model_path, torch_dtype=torch.float32).eval()
+    if draft_model.config.vocab_size != target_model.config.vocab_size:
+        raise ValueError("Draft and verifier must share a vocabulary")
+
+    test_data = load_dataset("json", data_files="test_aggregated.jsonl", split="train")
+    instruction = COMPACT_INSTRUCTION if COMPACT_OUTPUT else INSTRUCTION
+    stats = AcceptanceStats()
+    predictions = []
+    generated_tokens = 0
+    start = time.perf_counter()
+
+    for sample in tqdm(test_data, desc="Speculative decoding"):
+        messages = [
+            {"role": "system", "content": instruction.strip()},
+            {"role": "user", "content": sample['text']}
+        ]
+        prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        input_ids = tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        output_ids = speculative_generate(
+            draft_model, target_model, tokenizer, input_ids, stats, num_draft_tokens
+        )
+        generated_tokens += len(output_ids)
+        generated_text = tokenizer.decode(output_ids, skip_special_tokens=True).strip()
+
+        try:
+            predicted = normalize_schema(extract_outer_json(generated_text))
+            predictions.append({
+                "comment_id": sample.get("comment_id"),
+                "text": sample.get("text"),
+                "expected": normalize_schema(sample),
+                "predicted": predicted,
+                "raw_output": generated_text,
+                "success": True
+            })
+        except Exception:
+            predictions.append({
+                "comment_id": sample.get("comment_id"),
+                "text": sample.get("text"),
+                "raw_output": generated_text,
+                "success": False
+            })
+
+    elapsed = time.perf_counter() - start
+    with open(output_file, "w") as f:
+        for pred in predictions:
+            f.write(json.dumps(pred) + "\n")
+
+    print(f"\n Generated {generated_tokens} tokens in {elapsed:.1f}s ({generated_tokens / elapsed:.1f} tokens/s)")
+    print(stats.report())
+    return predictions
+
 print(" Starting Llama LoRA Testing Pipeline")
 merged_path = merge_lora_model()
 
 # Step 2: Run inference with vLLM
 predictions = run_inference_vllm_merged(merged_path)
 
+# Optional: speculative decoding on CPU, the merged 1B drafting for a merged 3B
+# verifier_path = merge_lora_model("meta-llama/Llama-3.2-3B-Instruct",
+#                                  "/content/llama3.2-3B-ctrl-alt-del-h8-r32",
+#                                  "llama-3B-merged-r32")
+# speculative_predictions = run_inference_speculative(merged_path, verifier_path)
+
 print("\n" + "="*60)
 print(" PIPELINE COMPLETE!")
 print("="*60)
@@ -1121,6 +1502,10 @@ def normalize_schema(data):
             # Fallback if prediction is just a raw string/sentence
             return {"overall": {"label": "neutral", "hate_speech_score": 0}, "facets": {}, "targets": {}}
 
+    # Expand compact {"s", "f", "t"} responses into the nested schema first
+    if "facets" not in data and any(key in data for key in ("s", "f", "t")):
+        data = expand_compact(data)
+
     # 2. Extract overall
     overall = data.get("overall", {})
 
@@ -0,0 +1,176 @@
+"""Rate-limited, self-tuning request scheduler for the Gemini API runner.
+
+A fixed batch size with a sleep after every batch leaves most of the
+quota unused. Here a pool of worker tasks shares three limits:
+
+- token buckets for requests per minute and tokens per minute, so the
+  quota is spent as fast as it refills and never faster;
+- an AIMD concurrency limit: each success adds about one request in
+  flight per round trip, each throttling or server error answer (429,
+  5xx) halves it, so a struggling backend also gets less parallelism;
+- retries with full-jitter exponential backoff for throttling, server
+  errors and dropped connections.
+
+Errors carry their HTTP status as ``.code`` (google.api_core exceptions do),
+which is how throttling is told apart from other failures.
+"""
+import asyncio
+import random
+import time
+
+RETRY_CODES = {429, 500, 502, 503, 504}
+THROTTLE_CODES = RETRY_CODES  # Answers that also halve the concurrency limit
+
+
+def status_code(exc):
+    code = getattr(exc, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(exc):
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return status_code(exc) in RETRY_CODES
+
+
+class TokenBucket:
+    """Allow ``per_minute`` units a minute, with bursts up to ``capacity``."""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Wait until ``amount`` units are available and take them (FIFO)."""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """Additive-increase, multiplicative-decrease limit on requests in flight.
+
+    The limit grows by ``1 / limit`` per success (about +1 per round trip
+    at full load) and is multiplied by ``decrease`` on a 429 or 5xx. Only
+    requests sent after the last decrease can cause another, so a burst of
+    errors from one round trip counts once.
+    """
+
+    def __init__(self, initial=2, maximum=16, minimum=1, decrease=0.5):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.changed = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait for a free slot. Pass the request's send time to release()."""
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, sent, throttled=False, succeeded=False):
+        async with self.changed:
+            self.in_flight -= 1
+            if throttled and sent > self.last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = time.monotonic()
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.changed.notify_all()
+
+
+class ApiScheduler:
+    """Run an async ``call`` per item under RPM/TPM and AIMD limits, with retries."""
+
+    def __init__(
+        self,
+        rpm=None,
+        tpm=None,
+        max_concurrency=16,
+        initial_concurrency=2,
+        max_retries=5,
+        base_delay=1.0,
+        max_delay=60.0,
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failed": 0}
+
+    async def submit(self, call, item, tokens=1):
+        """Await ``call(item)``, retrying retryable errors with jittered backoff.
+
+        The concurrency slot is taken first and the RPM/TPM tokens only right
+        before the call, so workers waiting on the AIMD limit hold no tokens
+        and cannot later go out in a burst past the rate limits.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.concurrency.acquire()
+            if self.requests:
+                await self.requests.acquire()
+            if self.tokens:
+                await self.tokens.acquire(tokens)
+            sent = time.monotonic()
+            self.stats["requests"] += 1
+            try:
+                result = await call(item)
+            except Exception as exc:
+                throttled = status_code(exc) in THROTTLE_CODES
+                self.stats["throttled"] += throttled
+                await self.concurrency.release(sent, throttled=throttled)
+                if attempt == self.max_retries or not is_retryable(exc):
+                    raise
+                self.stats["retries"] += 1
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                await asyncio.sleep(random.uniform(0, delay))
+            else:
+                await self.concurrency.release(sent, succeeded=True)
+                return result
+
+    async def run(self, call, items, on_done, tokens=None):
+        """Submit every item from ``max_concurrency`` workers.
+
+        ``on_done(item, result, error)`` is called as each item finishes,
+        in completion order; ``error`` is the final exception or None.
+        ``tokens(item)`` estimates an item's tokens for the TPM bucket.
+        """
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        async def worker():
+            while not queue.empty():
+                item = queue.get_nowait()
+                try:
+                    result = await self.submit(call, item, tokens(item) if tokens else 1)
+                except Exception as exc:
+                    self.stats["failed"] += 1
+                    on_done(item, None, exc)
+                else:
+                    on_done(item, result, None)
+
+        await asyncio.gather(*[worker() for _ in range(self.max_concurrency)])
+
+    def report(self):
+        return (
+            f"API scheduler: {self.stats['requests']} requests, {self.stats['retries']} retries, "
+            f"{self.stats['throttled']} throttled, {self.stats['failed']} failed, "
+            f"final concurrency limit {self.concurrency.limit:.1f}"
+        )
@@ -0,0 +1,42 @@
+"""Length-bucketed batch planning for the local HF runners."""
+
+
+def plan_batches(lengths, token_budget, max_batch_size=None):
+    """Group sample indices into batches of similar token length.
+
+    Samples are sorted longest first and packed greedily, so each batch
+    holds neighbours in length and its padded size (longest row x rows)
+    stays within ``token_budget``. A sample longer than the budget still
+    gets a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    current, longest = [], 0
+    for i in order:
+        longest_if_added = max(longest, lengths[i])
+        full = max_batch_size is not None and len(current) >= max_batch_size
+        if current and (full or longest_if_added * (len(current) + 1) > token_budget):
+            batches.append(current)
+            current, longest_if_added = [], lengths[i]
+        current.append(i)
+        longest = longest_if_added
+    if current:
+        batches.append(current)
+    return batches
+
+
+def fixed_batches(num_samples, batch_size):
+    """Consecutive chunks of ``batch_size`` indices, the old runner behaviour."""
+    return [
+        list(range(i, min(i + batch_size, num_samples)))
+        for i in range(0, num_samples, batch_size)
+    ]
+
+
+def padding_ratio(lengths, batches):
+    """Fraction of the padded token grid that is padding."""
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    real = sum(lengths[i] for batch in batches for i in batch)
+    if padded == 0:
+        return 0.0
+    return (padded - real) / padded
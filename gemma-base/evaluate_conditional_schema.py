@@ -0,0 +1,91 @@
+"""Measure what a CONDITIONAL_THRESHOLD cutoff costs before running with it.
+
+Schema-mode decoding writes overall and facets before targets, so a run
+with a cutoff gives exactly the full run's predictions with the skipped
+sections defaulted wherever the score fell below the threshold. This
+replays that on a validated full schema-mode run for a range of thresholds
+and reports the share of value slots saved next to the metric deltas.
+"""
+import copy
+import json
+import os
+import tempfile
+
+from evaluate_gemma_base import TEST_FILE, evaluate, load_jsonl
+from validate_schema import FACETS_SCHEMA, TARGETS_SCHEMA
+
+PREDICTIONS_FILE = "./baseline_data/gemma_baseline_outputs_validated.jsonl"
+OUTPUT_EVAL = "./baseline_data/conditional_schema_eval.txt"
+THRESHOLDS = [-2.0, -1.5, -1.0, -0.5, 0.0, 0.5]
+CONDITIONAL_SECTIONS = ("targets",)  # Match CONDITIONAL_SECTIONS in local_model.py
+
+SECTION_DEFAULTS = {
+    "facets": {key: 0 for key in FACETS_SCHEMA},
+    "targets": {key: False for key in TARGETS_SCHEMA},
+}
+OVERALL_SLOTS = 2  # hate_speech_score and label
+
+
+def overall_score(prediction):
+    overall = prediction.get("overall", {})
+    return overall.get("hate_speech_score", overall.get("score", 0.0))
+
+
+def apply_cutoff(records, threshold, sections):
+    """Default ``sections`` of every prediction scored below ``threshold``.
+
+    Returns the new records and how many predictions were cut.
+    """
+    records = copy.deepcopy(records)
+    skipped = 0
+    for record in records:
+        prediction = record["prediction"]
+        if prediction is not None and overall_score(prediction) < threshold:
+            for section in sections:
+                prediction[section] = dict(SECTION_DEFAULTS[section])
+            skipped += 1
+    return records, skipped
+
+
+def evaluate_records(records):
+    """Run the standard evaluation on in-memory records via a temp file."""
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    try:
+        return evaluate(TEST_FILE, f.name)
+    finally:
+        os.remove(f.name)
+
+
+def main():
+    records = load_jsonl(PREDICTIONS_FILE)
+    baseline = evaluate_records(records)
+    total_slots = OVERALL_SLOTS + len(FACETS_SCHEMA) + len(TARGETS_SCHEMA)
+    section_slots = sum(len(SECTION_DEFAULTS[section]) for section in CONDITIONAL_SECTIONS)
+
+    lines = [f"Conditional schema cutoff on {PREDICTIONS_FILE}", ""]
+    lines.append("=== FULL SCHEMA ===")
+    lines += [f"{name}: {value:.4f}" for name, value in baseline.items() if name != "valid"]
+    lines.append("")
+
+    for threshold in THRESHOLDS:
+        cut, skipped = apply_cutoff(records, threshold, CONDITIONAL_SECTIONS)
+        metrics = evaluate_records(cut)
+        lines.append(f"=== score < {threshold:+.2f} skips {', '.join(CONDITIONAL_SECTIONS)} ===")
+        lines.append(f"Comments skipping: {skipped / len(records):.1%}")
+        lines.append(f"Value slots saved: {skipped * section_slots / (len(records) * total_slots):.1%}")
+        for name, value in metrics.items():
+            if name != "valid":
+                lines.append(f"{name}: {value:.4f} ({value - baseline[name]:+.4f})")
+        lines.append("")
+
+    with open(OUTPUT_EVAL, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+    print("\n".join(lines))
+    print(f"Metrics written to {OUTPUT_EVAL}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,9 +13,13 @@ def load_jsonl(path):
         return [json.loads(line) for line in f]
 
 
-def main():
-    gold = load_jsonl(TEST_FILE)
-    preds = load_jsonl(OUTPUT_FILE)
+def evaluate(test_file, predictions_file):
+    """Score a validated predictions file against the gold test set.
+
+    Returns a dict of metrics; ``valid`` counts the predictions scored.
+    """
+    gold = load_jsonl(test_file)
+    preds = load_jsonl(predictions_file)
 
     gold_data, model_outputs = [], []
     for p in preds:
@@ -27,8 +31,6 @@ def main():
 
     print(f"Evaluating {len(model_outputs)} valid responses...")
 
-    lines = []
-
     # === OVERALL === (evaluate using labels instead of scores)
     y_true = [x["overall"]["label"] for x in gold_data]
     y_pred = [x["overall"].get("label") for x in model_outputs]
@@ -42,9 +44,6 @@ def main():
         y_true, y_pred, average="macro", labels=unique_labels, zero_division=0
     )
 
-    lines.append("=== OVERALL (label-based) ===")
-    lines.append(f"Micro F1: {overall_micro_f1:.4f}")
-    lines.append(f"Macro F1: {overall_macro_f1:.4f}\n")
 
     # === FACETS ===
     facet_names = gold_data[0]["facets"].keys()
@@ -55,9 +54,6 @@ def main():
         facet_mae[f] = mean_absolute_error(y_true, y_pred)
         facet_corr[f] = spearmanr(y_true, y_pred).correlation
 
-    lines.append("=== FACETS ===")
-    lines.append(f"Mean MAE: {np.mean(list(facet_mae.values())):.4f}")
-    lines.append(f"Mean Spearman: {np.nanmean(list(facet_corr.values())):.4f}\n")
 
     # === TARGETS ===
     target_names = gold_data[0]["targets"].keys()
@@ -71,9 +67,32 @@ def main():
     micro_f1 = f1_score(y_true, y_pred, average="micro", zero_division=0)
     macro_f1_targets = f1_score(y_true, y_pred, average="macro", zero_division=0)
 
+    return {
+        "valid": len(model_outputs),
+        "label_micro_f1": overall_micro_f1,
+        "label_macro_f1": overall_macro_f1,
+        "facet_mae": np.mean(list(facet_mae.values())),
+        "facet_spearman": np.nanmean(list(facet_corr.values())),
+        "target_micro_f1": micro_f1,
+        "target_macro_f1": macro_f1_targets,
+    }
+
+
+def main():
+    metrics = evaluate(TEST_FILE, OUTPUT_FILE)
+
+    lines = []
+    lines.append("=== OVERALL (label-based) ===")
+    lines.append(f"Micro F1: {metrics['label_micro_f1']:.4f}")
+    lines.append(f"Macro F1: {metrics['label_macro_f1']:.4f}\n")
+
+    lines.append("=== FACETS ===")
+    lines.append(f"Mean MAE: {metrics['facet_mae']:.4f}")
+    lines.append(f"Mean Spearman: {metrics['facet_spearman']:.4f}\n")
+
     lines.append("=== TARGETS ===")
-    lines.append(f"Micro F1: {micro_f1:.4f}")
-    lines.append(f"Macro F1: {macro_f1_targets:.4f}\n")
+    lines.append(f"Micro F1: {metrics['target_micro_f1']:.4f}")
+    lines.append(f"Macro F1: {metrics['target_macro_f1']:.4f}\n")
 
     lines.append("✅ Evaluation complete.\n")
 
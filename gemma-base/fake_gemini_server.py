@@ -0,0 +1,180 @@
+"""Local stand-in for the Gemini generateContent REST endpoint.
+
+Answers every ``POST .../models/<model>:generateContent`` with a schema-valid
+prediction made up from a hash of the comment. It can also misbehave the
+way the real API does: quota 429s past --rpm or --max-in-flight, random
+500s and latency. That is enough to exercise run_inference.py's scheduler
+without spending quota:
+
+    python fake_gemini_server.py --port 8089 --rpm 120 --max-in-flight 8
+    GEMINI_API_ENDPOINT=http://127.0.0.1:8089 GOOGLE_API_KEY=fake python run_inference.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from validate_schema import FACETS_SCHEMA, TARGETS_SCHEMA
+
+TEXT_MARKER = "TEXT TO ANALYZE\n=========================\n"
+PACKED_MARKER = "TEXTS TO ANALYZE\n=========================\n"
+
+
+def fake_prediction(text):
+    """A deterministic, schema-valid prediction for ``text``."""
+    rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+    score = round(rng.uniform(-2.0, 2.0), 2)
+    label = "hateful" if score > 0.5 else "supportive" if score < -1.0 else "neutral"
+    return {
+        "overall": {"hate_speech_score": score, "label": label},
+        "facets": {key: rng.randint(0, 4) for key in FACETS_SCHEMA},
+        "targets": {key: rng.random() < 0.05 for key in TARGETS_SCHEMA},
+    }
+
+
+def answer(prompt):
+    """Model text for one prompt: the prediction for the text after the marker.
+
+    Packed prompts (a JSON array of comment_id/text objects) get a JSON
+    array of predictions tagged with their comment_id.
+    """
+    if PACKED_MARKER in prompt:
+        texts = json.loads(prompt.split(PACKED_MARKER, 1)[1])
+        return json.dumps(
+            [{"comment_id": item["comment_id"], **fake_prediction(item["text"])} for item in texts],
+            indent=2,
+        )
+    text = prompt.split(TEXT_MARKER, 1)[-1].strip()
+    return json.dumps(fake_prediction(text), indent=2)
+
+
+class FakeGemini:
+    """Shared state of the fake server: limits, counters and request log."""
+
+    def __init__(self, rpm=None, max_in_flight=None, error_rate=0.0, latency=0.2):
+        self.rpm = rpm
+        self.max_in_flight = max_in_flight
+        self.error_rate = error_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.recent = deque()  # Arrival times within the last minute
+        self.in_flight = 0
+        self.counts = {"ok": 0, "429": 0, "500": 0}
+
+    def admit(self):
+        """Return the HTTP status to answer with before doing any work."""
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            if self.rpm and len(self.recent) >= self.rpm:
+                self.counts["429"] += 1
+                return 429
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.counts["429"] += 1
+                return 429
+            self.recent.append(now)
+            if random.random() < self.error_rate:
+                self.counts["500"] += 1
+                return 500
+            self.in_flight += 1
+            return 200
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.counts["ok"] += 1
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like the real endpoint
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.split("?")[0].endswith(":generateContent"):
+                self.send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError:
+                self.send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "status": "INVALID_ARGUMENT"}})
+                return
+            prompt = "".join(
+                part.get("text", "")
+                for content in request.get("contents", [])
+                for part in content.get("parts", [])
+            )
+
+            status = state.admit()
+            if status == 429:
+                self.send_json(429, {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}})
+                return
+            if status == 500:
+                self.send_json(500, {"error": {"code": 500, "message": "Internal error", "status": "INTERNAL"}})
+                return
+
+            if state.latency:
+                time.sleep(random.expovariate(1 / state.latency))
+            text = answer(prompt)
+            state.done()
+            self.send_json(
+                200,
+                {
+                    "candidates": [
+                        {
+                            "content": {"parts": [{"text": text}], "role": "model"},
+                            "finishReason": "STOP",
+                            "index": 0,
+                        }
+                    ],
+                    "usageMetadata": {
+                        "promptTokenCount": len(prompt) // 4,
+                        "candidatesTokenCount": len(text) // 4,
+                        "totalTokenCount": (len(prompt) + len(text)) // 4,
+                    },
+                },
+            )
+
+        def log_message(self, format, *args):
+            pass  # One line per request would drown the counters
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini generateContent server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--rpm", type=int, help="429 past this many requests per minute")
+    parser.add_argument("--max-in-flight", type=int, help="429 past this many concurrent requests")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean seconds per answer")
+    args = parser.parse_args()
+
+    state = FakeGemini(args.rpm, args.max_in_flight, args.error_rate, args.latency)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"Fake Gemini listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Requests: {state.counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Async client for the Gemini generateContent REST endpoint.
+
+The google.generativeai SDK call is blocking, so run_inference.py had to
+push it through asyncio.to_thread: every request in flight held an OS
+thread, and the default thread pool capped concurrency. This client speaks
+the REST API directly from the event loop over one pooled httpx client
+(keep-alive, and HTTP/2 multiplexing when the h2 package is installed), so
+hundreds of requests can be in flight cheaply.
+"""
+import importlib.util
+
+import httpx
+
+DEFAULT_ENDPOINT = "https://generativelanguage.googleapis.com"
+
+
+class GeminiHTTPError(Exception):
+    """Non-2xx answer from the API; ``code`` is the HTTP status."""
+
+    def __init__(self, code, status, message):
+        super().__init__(f"{code} {status}: {message}")
+        self.code = code
+        self.status = status
+
+
+class GeminiRestClient:
+    """Send prompts to ``models/<model>:generateContent`` and return the text.
+
+    Transport failures are raised as ConnectionError and API errors as
+    GeminiHTTPError, so api_scheduler can tell which ones to retry.
+    """
+
+    def __init__(self, api_key, model, endpoint=None, max_connections=100, timeout=120.0):
+        self.url = f"{(endpoint or DEFAULT_ENDPOINT).rstrip('/')}/v1beta/models/{model}:generateContent"
+        self.client = httpx.AsyncClient(
+            headers={"x-goog-api-key": api_key or ""},
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+
+    async def generate_content(self, prompt):
+        body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        try:
+            response = await self.client.post(self.url, json=body)
+        except httpx.TransportError as exc:
+            raise ConnectionError(f"{type(exc).__name__}: {exc}") from exc
+
+        if response.status_code >= 400:
+            try:
+                error = response.json()["error"]
+            except (ValueError, KeyError, TypeError):
+                error = {"status": response.reason_phrase, "message": response.text[:200]}
+            raise GeminiHTTPError(
+                response.status_code, error.get("status", ""), error.get("message", "")
+            )
+
+        candidates = response.json().get("candidates") or []
+        if not candidates:
+            # Same as the SDK's response.text on a blocked prompt
+            raise ValueError("Response has no candidates (prompt may have been blocked)")
+        parts = candidates[0].get("content", {}).get("parts", [])
+        return "".join(part.get("text", "") for part in parts)
+
+    async def aclose(self):
+        await self.client.aclose()
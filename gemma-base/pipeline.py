@@ -0,0 +1,161 @@
+"""Run batches through prepare -> model -> parse -> write stages on threads.
+
+The model stage runs on the calling thread. Preparing inputs (tokenizing,
+padding, copying the prefix cache), parsing the outputs and writing them
+each run on their own threads, linked by bounded queues. As long as those
+stages keep up, the model never waits on tokenization, JSON handling or
+disk. Queue depths are sampled every time the model takes a batch, so the
+report shows which stage held the others up.
+"""
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class StagedPipeline:
+    """Four-stage pipeline over a list of items (usually batches).
+
+    ``prepare`` runs on one producer thread, ``model`` on the calling
+    thread, ``parse`` on ``parse_workers`` threads and ``write`` on one
+    writer thread. The writer gets results in item order: results that
+    finish early wait in a reorder buffer. If any stage raises, the other
+    stages drain their queues and ``run`` re-raises the first error.
+    """
+
+    def __init__(self, prepare, model, parse, write, parse_workers=2, queue_size=4):
+        self.prepare = prepare
+        self.model = model
+        self.parse = parse
+        self.write = write
+        self.parse_workers = parse_workers
+        self.queues = {
+            "prepared": queue.Queue(queue_size),
+            "generated": queue.Queue(queue_size),
+            "parsed": queue.Queue(queue_size),
+        }
+        self.reorder = {}
+        self.error = None
+        self.samples = 0
+        self.depth_sum = dict.fromkeys([*self.queues, "reorder"], 0)
+        self.depth_max = dict.fromkeys([*self.queues, "reorder"], 0)
+        self.busy = self.starved = self.blocked = 0.0
+
+    def depths(self):
+        """Current size of every queue and of the reorder buffer."""
+        depths = {name: q.qsize() for name, q in self.queues.items()}
+        depths["reorder"] = len(self.reorder)
+        return depths
+
+    def _sample(self):
+        self.samples += 1
+        for name, depth in self.depths().items():
+            self.depth_sum[name] += depth
+            self.depth_max[name] = max(self.depth_max[name], depth)
+
+    def _produce(self, items):
+        prepared = self.queues["prepared"]
+        for index, item in enumerate(items):
+            if self.error is not None:
+                break
+            try:
+                prepared.put((index, self.prepare(item)))
+            except BaseException as exc:
+                self.error = exc
+        prepared.put(_DONE)
+
+    def _parse_loop(self):
+        generated, parsed = self.queues["generated"], self.queues["parsed"]
+        while True:
+            item = generated.get()
+            if item is _DONE:
+                parsed.put(_DONE)
+                return
+            if self.error is not None:
+                continue
+            index, value = item
+            try:
+                parsed.put((index, self.parse(value)))
+            except BaseException as exc:
+                self.error = exc
+
+    def _write_loop(self):
+        parsed = self.queues["parsed"]
+        finished, next_index = 0, 0
+        while finished < self.parse_workers:
+            item = parsed.get()
+            if item is _DONE:
+                finished += 1
+                continue
+            index, value = item
+            self.reorder[index] = value
+            while next_index in self.reorder and self.error is None:
+                try:
+                    self.write(self.reorder.pop(next_index))
+                except BaseException as exc:
+                    self.error = exc
+                next_index += 1
+
+    def run(self, items, progress=None):
+        """Push ``items`` through every stage; ``progress`` is an optional tqdm bar."""
+        items = list(items)
+        threads = [threading.Thread(target=self._produce, args=(items,), daemon=True)]
+        threads += [
+            threading.Thread(target=self._parse_loop, daemon=True)
+            for _ in range(self.parse_workers)
+        ]
+        threads.append(threading.Thread(target=self._write_loop, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        prepared, generated = self.queues["prepared"], self.queues["generated"]
+        while True:
+            start = time.perf_counter()
+            item = prepared.get()
+            self.starved += time.perf_counter() - start
+            if item is _DONE:
+                break
+            self._sample()
+            if self.error is not None:
+                continue  # Keep draining so the producer can finish
+
+            index, value = item
+            start = time.perf_counter()
+            try:
+                value = self.model(value)
+            except BaseException as exc:
+                self.error = exc
+                continue
+            self.busy += time.perf_counter() - start
+
+            start = time.perf_counter()
+            generated.put((index, value))
+            self.blocked += time.perf_counter() - start
+            if progress is not None:
+                progress.update(1)
+                progress.set_postfix(self.depths())
+
+        for _ in range(self.parse_workers):
+            generated.put(_DONE)
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def report(self):
+        """Lines summarizing where the model stage spent its time and queue depths."""
+        lines = [
+            f"Model stage: busy {self.busy:.1f}s, waiting for input {self.starved:.1f}s, "
+            f"blocked on output {self.blocked:.1f}s"
+        ]
+        for name in self.depth_sum:
+            mean = self.depth_sum[name] / max(self.samples, 1)
+            lines.append(f"Queue {name}: mean depth {mean:.1f}, max {self.depth_max[name]}")
+        if self.starved > max(self.blocked, 0.1 * self.busy):
+            lines.append("Bottleneck: prepare (the model waited for input)")
+        elif self.blocked > 0.1 * self.busy:
+            lines.append("Bottleneck: parse/write (the model waited for room downstream)")
+        else:
+            lines.append("Bottleneck: model")
+        return lines
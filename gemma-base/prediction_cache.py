@@ -0,0 +1,91 @@
+"""Content-addressed on-disk cache of model predictions.
+
+Every runner shares one SQLite file. A prediction is keyed by a hash of
+everything that decides it: the model (hub id or hashed local weights, plus
+any adapter), the rendered prompt template, the decoding parameters and the
+normalized comment text. Repeating a configuration costs a lookup instead of
+a model call, and changing any of those inputs simply misses.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import unicodedata
+
+CACHE_PATH = "../prediction_cache.sqlite"
+WEIGHT_SUFFIXES = (".safetensors", ".bin", ".json", ".model")
+
+
+def normalize_text(text):
+    """Unicode-normalize and collapse whitespace so trivial variants share a key."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def hash_model_dir(path):
+    """Hash the weight, config and tokenizer files of a local model or adapter."""
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(WEIGHT_SUFFIXES):
+            continue
+        digest.update(name.encode("utf-8"))
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_id, adapter_path=None):
+    """Identify a model: the hub id, or a content hash for local directories."""
+    fingerprint = {"model": model_id}
+    if os.path.isdir(model_id):
+        fingerprint["model"] = "sha256:" + hash_model_dir(model_id)
+    if adapter_path is not None:
+        fingerprint["adapter"] = "sha256:" + hash_model_dir(adapter_path)
+    return fingerprint
+
+
+class PredictionCache:
+    """SQLite-backed map from (configuration, text) to a stored prediction.
+
+    ``namespace`` is any JSON-serializable description of the configuration
+    (model fingerprint, prompt template, decoding parameters); it is folded
+    into every key.
+    """
+
+    def __init__(self, namespace, path=CACHE_PATH):
+        self.namespace = json.dumps(namespace, sort_keys=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, prediction TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def key(self, text):
+        payload = self.namespace + "\0" + normalize_text(text)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_many(self, texts):
+        """Return {index: prediction} for the texts that are already cached."""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            rows = self.conn.execute(
+                "SELECT key, prediction FROM predictions WHERE key IN "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            found.update(rows)
+        return {
+            i: json.loads(found[key]) for i, key in enumerate(keys) if key in found
+        }
+
+    def put_many(self, items):
+        """Store (text, prediction) pairs, replacing older values."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO predictions (key, prediction) VALUES (?, ?)",
+            [(self.key(text), json.dumps(prediction)) for text, prediction in items],
+        )
+        self.conn.commit()
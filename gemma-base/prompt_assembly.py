@@ -0,0 +1,69 @@
+"""Build prompt token ids from pre-tokenized template pieces.
+
+Rendering the chat template and tokenizing the ~1,000 token instruction
+again for every comment costs CPU time next to the model itself. Instead
+the template is rendered once with a placeholder where the comment goes,
+the text on either side is tokenized once, and each batch of comments is
+tokenized with a single fast-tokenizer call and spliced in between.
+
+The splice only matches the full render-and-tokenize path if no token
+would have spanned a piece boundary. Comments that start or end with
+whitespace or punctuation can merge with the template around them (an
+ending "!" and the following "\n\n" are one Llama-3 token), so every text
+is also tokenized between short stretches of the template on either side.
+Texts whose ids change there are left to the full path; runners also check
+a sample against that path before relying on the splice.
+"""
+
+
+class PromptAssembler:
+    """Token ids of ``head + text + tail`` without re-tokenizing head and tail.
+
+    ``rendered`` is the chat-templated prompt with ``placeholder`` where the
+    comment goes. The head is tokenized with the tokenizer's special tokens
+    (as a whole prompt would be); the text and tail are not. ``edge`` is how
+    many characters of template on each side the boundary check uses.
+    """
+
+    def __init__(self, tokenizer, rendered, placeholder="{text}", edge=16):
+        self.tokenizer = tokenizer
+        start = rendered.index(placeholder)
+        self.head_text = rendered[:start]
+        self.tail_text = rendered[start + len(placeholder) :]
+        self.head_ids = tokenizer(self.head_text)["input_ids"]
+        self.tail_ids = tokenizer(self.tail_text, add_special_tokens=False)["input_ids"]
+        self.head_edge = self.head_text[-edge:]
+        self.tail_edge = self.tail_text[:edge]
+        self.edge_ids = (
+            tokenizer(self.head_edge, add_special_tokens=False)["input_ids"],
+            tokenizer(self.tail_edge, add_special_tokens=False)["input_ids"],
+        )
+
+    def token_ids(self, texts, include_head=True, max_length=None):
+        """Token ids for each text, cut to ``max_length`` like ``truncation=True``.
+
+        With ``include_head=False`` the ids start right after the head, for
+        callers that already hold the head in a KV cache. A text whose tokens
+        would merge with the template around it gets None instead.
+        """
+        texts = list(texts)
+        head = self.head_ids if include_head else []
+        text_ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        framed_ids = self.tokenizer(
+            [self.head_edge + text + self.tail_edge for text in texts], add_special_tokens=False
+        )["input_ids"]
+        head_edge_ids, tail_edge_ids = self.edge_ids
+        return [
+            (head + ids + self.tail_ids)[:max_length]
+            if framed == head_edge_ids + ids + tail_edge_ids
+            else None
+            for ids, framed in zip(text_ids, framed_ids)
+        ]
+
+
+def first_mismatch(assembled, expected):
+    """Index of the first row whose ids differ, or None if all are identical."""
+    for index, (ids, reference) in enumerate(zip(assembled, expected)):
+        if list(ids) != list(reference):
+            return index
+    return None
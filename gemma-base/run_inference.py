@@ -4,15 +4,38 @@ from google import genai
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from api_scheduler import ApiScheduler
+from gemini_rest_client import GeminiRestClient
+from prediction_cache import PredictionCache
+
 # ========== CONFIG ==========
 load_dotenv()
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel("gemma-3-1b-it")
+API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")  # e.g. http://127.0.0.1:8089 for fake_gemini_server.py
+if API_ENDPOINT:
+    genai.configure(
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        transport="rest",
+        client_options={"api_endpoint": API_ENDPOINT},
+    )
+else:
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+MODEL_NAME = "gemma-3-1b-it"
+model = genai.GenerativeModel(MODEL_NAME)
 
 TEST_FILE = "../data/test.jsonl"
 OUTPUT_FILE = "./baseline_data/gemma_baseline_outputs.jsonl"
-BATCH_SIZE = 1
-SLEEP_TIME = 3
+RPM_LIMIT = 30  # Requests per minute allowed by the quota
+TPM_LIMIT = 15000  # Input + output tokens per minute allowed by the quota
+API_CLIENT = "rest"  # "rest" (async httpx, no thread per request) or "sdk" (google.generativeai in threads)
+MAX_CONCURRENCY = 64  # Upper bound for the adaptive number of requests in flight ("sdk" is also capped by the thread pool)
+INITIAL_CONCURRENCY = 2
+MAX_RETRIES = 5  # Per request, for 429/5xx and dropped connections
+OUTPUT_TOKEN_ESTIMATE = 600  # Tokens one answer costs against TPM_LIMIT
+PACK_COMMENTS = True  # Send several comments per request and split the JSON array answer
+PACK_INPUT_TOKENS = 2000  # Comment tokens per packed request; long comments get smaller packs
+MAX_PACK_SIZE = 8  # Each answer is ~OUTPUT_TOKEN_ESTIMATE tokens; 8 stays inside the output limit
+USE_PREDICTION_CACHE = True  # Reuse predictions made before under the exact same configuration
+PREDICTION_CACHE_PATH = "../prediction_cache.sqlite"  # Shared by every runner
 # =============================
 
 SYSTEM_PROMPT = """You are an expert hate speech analyst. Your task is to analyze the provided text and return ONLY a valid JSON object that strictly follows the schema below. 
@@ -140,6 +163,43 @@ TEXT TO ANALYZE
 """
 
 
+PACKED_PROMPT = SYSTEM_PROMPT[: SYSTEM_PROMPT.index("=========================\nTEXT TO ANALYZE")] + """=========================
+MULTIPLE TEXTS
+=========================
+This request contains several texts, given as a JSON array of objects with a `"comment_id"` and a `"text"`.
+Analyze each text on its own. Instead of a single object, return ONLY a JSON array with one object per text, in the same order.
+Each object must match the schema above and also contain `"comment_id"`, copied exactly from its text.
+
+=========================
+TEXTS TO ANALYZE
+=========================
+{texts}
+"""
+
+
+_prediction_cache = None
+
+
+def get_prediction_cache():
+    """Open the shared prediction cache under this model and prompt.
+
+    The API is called with its default generation config, so the first
+    answer stored for a comment is the one that gets reused.
+    """
+    global _prediction_cache
+    if _prediction_cache is None:
+        namespace = {
+            "model": f"gemini-api:{MODEL_NAME}",
+            "prompt": SYSTEM_PROMPT,
+            "decoding": {"generation_config": "api-default"},
+        }
+        if PACK_COMMENTS:
+            # Packed answers come from a different prompt
+            namespace["packed_prompt"] = PACKED_PROMPT
+        _prediction_cache = PredictionCache(namespace, PREDICTION_CACHE_PATH)
+    return _prediction_cache
+
+
 def load_data(path):
     with open(path, "r", encoding="utf-8") as f:
         return [json.loads(line) for line in f]
@@ -172,43 +232,209 @@ def extract_json(text: str):
         return None
 
 
-async def analyze(entry):
-    prompt = SYSTEM_PROMPT.replace("{text}", entry["text"])
-    try:
+_rest_client = None
+
+
+async def generate_text(prompt):
+    """Send one prompt through the configured API_CLIENT and return the answer text."""
+    global _rest_client
+    if API_CLIENT == "sdk":
         response = await asyncio.to_thread(model.generate_content, prompt)
-        output = response.text.strip()
+        return response.text
+    if _rest_client is None:
+        _rest_client = GeminiRestClient(
+            os.getenv("GOOGLE_API_KEY"),
+            MODEL_NAME,
+            endpoint=API_ENDPOINT,
+            max_connections=MAX_CONCURRENCY,
+        )
+    return await _rest_client.generate_content(prompt)
+
+
+async def close_client():
+    global _rest_client
+    if _rest_client is not None:
+        await _rest_client.aclose()
+        _rest_client = None
+
+
+def estimate_tokens(entry):
+    """Rough token cost of one request (about 4 characters per token)."""
+    return (len(SYSTEM_PROMPT) + len(entry["text"])) // 4 + OUTPUT_TOKEN_ESTIMATE
 
-        parsed = extract_json(output)
-        if parsed is None:
-            print(f"⚠️ Failed to parse JSON for {entry['comment_id']}")
+
+def extract_items(text):
+    """Every JSON object in a (possibly truncated or malformed) JSON array answer."""
+    cleaned = text.replace("```json", "").replace("```", "")
+    decoder = json.JSONDecoder()
+    items, pos = [], cleaned.find("{")
+    while pos != -1:
         try:
-            score = parsed["overall"]["score"]
-            if score > 0.5:
-                label = "hateful"
-            elif score < -1.0:
-                label = "supportive"
-            else:
-                label = "neutral"
-            parsed["overall"]["label"] = label
-        except Exception as e:
-            print(f"⚠️ Label generation error for {entry['comment_id']}: {e}")
-
-        return {"id": entry["comment_id"], "prediction": parsed}
+            item, end = decoder.raw_decode(cleaned, pos)
+        except json.JSONDecodeError:
+            pos = cleaned.find("{", pos + 1)
+            continue
+        if isinstance(item, dict):
+            items.append(item)
+        pos = cleaned.find("{", end)
+    return items
+
+
+def is_complete(item):
+    """Whether a packed answer item has every schema section and a numeric score."""
+    if not isinstance(item, dict):
+        return False
+    if not all(isinstance(item.get(key), dict) for key in ("overall", "facets", "targets")):
+        return False
+    score = item["overall"].get("hate_speech_score", item["overall"].get("score"))
+    return isinstance(score, (int, float)) and not isinstance(score, bool)
+
+
+def make_packs(entries):
+    """Group entries into packs of up to MAX_PACK_SIZE within PACK_INPUT_TOKENS."""
+    packs, pack, size = [], [], 0
+    for entry in entries:
+        tokens = len(entry["text"]) // 4
+        if pack and (size + tokens > PACK_INPUT_TOKENS or len(pack) == MAX_PACK_SIZE):
+            packs.append(pack)
+            pack, size = [], 0
+        pack.append(entry)
+        size += tokens
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+def estimate_pack_tokens(pack):
+    text_length = sum(len(entry["text"]) for entry in pack)
+    return (len(PACKED_PROMPT) + text_length) // 4 + OUTPUT_TOKEN_ESTIMATE * len(pack)
+
+
+def finish_prediction(entry, parsed):
+    """Add the label, cache the prediction and wrap it as a result record."""
+    try:
+        score = parsed["overall"]["score"]
+        if score > 0.5:
+            label = "hateful"
+        elif score < -1.0:
+            label = "supportive"
+        else:
+            label = "neutral"
+        parsed["overall"]["label"] = label
     except Exception as e:
-        print(f"❌ Error on {entry['comment_id']}: {e}")
-        return {"id": entry["comment_id"], "prediction": None}
+        print(f"⚠️ Label generation error for {entry['comment_id']}: {e}")
+
+    # Only answers that parsed are cached; API errors and unparseable answers
+    # are retried next run, since the API does not answer deterministically
+    if USE_PREDICTION_CACHE and parsed is not None:
+        get_prediction_cache().put_many([(entry["text"], parsed)])
+    return {"id": entry["comment_id"], "prediction": parsed}
+
+
+async def analyze(entry):
+    """Score one comment. API errors propagate so the scheduler can retry them."""
+    prompt = SYSTEM_PROMPT.replace("{text}", entry["text"])
+    output = (await generate_text(prompt)).strip()
+
+    parsed = extract_json(output)
+    if parsed is None:
+        print(f"⚠️ Failed to parse JSON for {entry['comment_id']}")
+    return finish_prediction(entry, parsed)
+
+
+async def analyze_pack(pack):
+    """Score a pack of comments with one request.
+
+    Returns one result per entry, or None where the answer had no complete
+    item for that comment_id; those are re-requested one by one.
+    """
+    texts = [{"comment_id": entry["comment_id"], "text": entry["text"]} for entry in pack]
+    prompt = PACKED_PROMPT.replace("{texts}", json.dumps(texts, ensure_ascii=False, indent=2))
+    output = await generate_text(prompt)
+
+    items = {str(item.get("comment_id")): item for item in extract_items(output)}
+    results = []
+    for entry in pack:
+        item = items.get(str(entry["comment_id"]))
+        if not is_complete(item):
+            results.append(None)
+            continue
+        parsed = {key: item[key] for key in ("overall", "facets", "targets")}
+        results.append(finish_prediction(entry, parsed))
+    return results
+
+
+def make_scheduler():
+    return ApiScheduler(
+        rpm=RPM_LIMIT,
+        tpm=TPM_LIMIT,
+        max_concurrency=MAX_CONCURRENCY,
+        initial_concurrency=INITIAL_CONCURRENCY,
+        max_retries=MAX_RETRIES,
+    )
+
+
+async def predict(entries, scheduler, record):
+    """Predict every entry, calling ``record(result)`` as each one is ready.
+
+    Cache hits come first, then (with PACK_COMMENTS) the packed requests,
+    then single requests for whatever packing did not cover. Failed
+    requests are recorded with a null prediction.
+    """
+    if USE_PREDICTION_CACHE:
+        cached = get_prediction_cache().get_many([e["text"] for e in entries])
+        print(f"Prediction cache: {len(cached)} of {len(entries)} samples already predicted")
+        for i in sorted(cached):
+            record({"id": entries[i]["comment_id"], "prediction": cached[i]})
+        entries = [e for i, e in enumerate(entries) if i not in cached]
+
+    def on_done(entry, result, error):
+        if error is not None:
+            print(f"❌ Error on {entry['comment_id']}: {error}")
+            result = {"id": entry["comment_id"], "prediction": None}
+        record(result)
+
+    if PACK_COMMENTS and entries:
+        retry = []
+
+        def on_pack_done(pack, pack_results, error):
+            if error is not None:
+                print(f"❌ Error on a pack of {len(pack)}: {error}")
+                pack_results = [None] * len(pack)
+            for entry, result in zip(pack, pack_results):
+                if result is None:
+                    retry.append(entry)
+                else:
+                    record(result)
+
+        packs = make_packs(entries)
+        print(f"Packing {len(entries)} comments into {len(packs)} requests")
+        await scheduler.run(analyze_pack, packs, on_pack_done, tokens=estimate_pack_tokens)
+        if retry:
+            print(f"Re-requesting {len(retry)} comments one by one")
+        entries = retry
+
+    await scheduler.run(analyze, entries, on_done, tokens=estimate_tokens)
 
 
 async def run_inference(entries):
     results = []
+    scheduler = make_scheduler()
     with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
-        for i in tqdm(range(0, len(entries), BATCH_SIZE), desc="Running inference"):
-            batch = entries[i : i + BATCH_SIZE]
-            batch_results = await asyncio.gather(*[analyze(e) for e in batch])
-            for result in batch_results:
-                results.append(result)
-                f.write(json.dumps(result) + "\n")
-            await asyncio.sleep(SLEEP_TIME)
+        progress = tqdm(total=len(entries), desc="Running inference")
+
+        def record(result):
+            results.append(result)
+            f.write(json.dumps(result) + "\n")
+            progress.update(1)
+            progress.set_postfix(limit=f"{scheduler.concurrency.limit:.1f}")
+
+        try:
+            await predict(entries, scheduler, record)
+        finally:
+            await close_client()
+        progress.close()
+        print(scheduler.report())
     return results
 
 
@@ -0,0 +1,628 @@
+"""Schema-aware decoding helpers for the local runners.
+
+Every key name and piece of punctuation in the output schema is known in
+advance, so SchemaForcedDecoder pushes them through the model in one forward
+pass per segment and only runs the greedy decode loop at the value slots.
+SchemaLogitsProcessor applies the validate_schema type rules while tokens
+are generated, so each value slot can only produce a legal value.
+SchemaLikelihoodScorer skips generation altogether and reads each value from
+one teacher-forced pass over the filled-in skeleton.
+"""
+import re
+
+import torch
+from transformers import DynamicCache, LogitsProcessor
+
+from validate_schema import ALLOWED_LABELS, FACETS_SCHEMA, TARGETS_SCHEMA
+
+MAX_VALUE_TOKENS = 8  # Hard cap on decode steps per value slot
+
+# Written in place of a value the model did not finish
+VALUE_DEFAULTS = {
+    "float": "0.00",
+    "int": "0",
+    "bool": "false",
+    "label": '"neutral"',
+}
+
+# JSON number grammar: no leading zeros, so "007" or "-01.5" never get through
+_FLOAT_PREFIX = re.compile(r"-?((0|[1-9]\d*)(\.\d*)?)?")
+_FLOAT_VALUE = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?")
+_INT_PREFIX = re.compile(r"-?(0|[1-9]\d*)?")
+_INT_VALUE = re.compile(r"-?(0|[1-9]\d*)")
+_BOOL_VALUES = ("true", "false")
+_TERMINATOR_CHARS = set(",}\n ")  # What may follow a finished value
+_LABEL_VALUES = tuple(f'"{label}"' for label in sorted(ALLOWED_LABELS))
+
+# The values validate_schema accepts for each enumerable kind: facets are
+# clamped to 0-4, targets are booleans and labels one of ALLOWED_LABELS
+ALLOWED_VALUES = {
+    "int": tuple(str(value) for value in range(5)),
+    "bool": _BOOL_VALUES,
+    "label": _LABEL_VALUES,
+}
+
+
+def schema_fields():
+    """(section, key, kind) for every value in the output schema, in order."""
+    fields = [
+        ("overall", "hate_speech_score", "float"),
+        ("overall", "label", "label"),
+    ]
+    fields += [("facets", key, "int") for key in FACETS_SCHEMA]
+    fields += [("targets", key, "bool") for key in TARGETS_SCHEMA]
+    return fields
+
+
+def build_skeleton(fields=None):
+    """Split the output schema into forced text and value slots.
+
+    Returns a list of ``("text", str)`` and ``("value", (section, key, kind))``
+    items. Text segments stop at the colon: the tokenizers emit values as
+    single leading-space tokens (" true", " -"), so the space belongs to the
+    value slot. With the values filled in it renders the same layout as the
+    schema shown in SYSTEM_PROMPT.
+    """
+    items = []
+    text, section = "{\n", None
+    for field in fields or schema_fields():
+        field_section, key, _ = field
+        if field_section != section:
+            if section is not None:
+                text += "\n  },\n"
+            text += f'  "{field_section}": {{\n'
+            section = field_section
+        else:
+            text += ",\n"
+        text += f'    "{key}":'
+        items.append(("text", text))
+        items.append(("value", field))
+        text = ""
+    items.append(("text", "\n  }\n}"))
+    return items
+
+
+def is_value_prefix(kind, text):
+    """Whether ``text`` can still grow into a valid value of ``kind``."""
+    text = text.lstrip()
+    if kind == "float":
+        return _FLOAT_PREFIX.fullmatch(text) is not None
+    if kind == "int":
+        return _INT_PREFIX.fullmatch(text) is not None
+    if kind == "bool":
+        return any(value.startswith(text) for value in _BOOL_VALUES)
+    if kind == "label":
+        return any(value.startswith(text.lower()) for value in _LABEL_VALUES)
+    raise ValueError(f"Unknown value kind: {kind}")
+
+
+def is_complete_value(kind, text):
+    """Whether ``text`` is a finished JSON literal of ``kind``."""
+    text = text.strip()
+    if kind == "float":
+        return _FLOAT_VALUE.fullmatch(text) is not None
+    if kind == "int":
+        return _INT_VALUE.fullmatch(text) is not None
+    if kind == "bool":
+        return text in _BOOL_VALUES
+    if kind == "label":
+        return text.lower() in _LABEL_VALUES
+    raise ValueError(f"Unknown value kind: {kind}")
+
+
+def slot_kinds(fields=None):
+    """Map each value key in the schema to its kind."""
+    return {key: kind for _, key, kind in fields or schema_fields()}
+
+
+class ValueVocabulary:
+    """Allowed next tokens for a partially generated value.
+
+    The tokenizer vocabulary is scanned once for tokens that could appear in
+    any value and for tokens that close one (",", newline, "}"); masks are
+    then built lazily per (kind, text so far).
+    """
+
+    def __init__(self, tokenizer):
+        charset = set("0123456789.- ")
+        for values in ALLOWED_VALUES.values():
+            charset.update("".join(values))
+        self.candidates = []
+        self.terminators = []
+        for token_id in range(len(tokenizer)):
+            text = tokenizer.decode([token_id], skip_special_tokens=True)
+            if text and set(text) <= charset:
+                self.candidates.append((token_id, text))
+            elif text and text[0] in ",}\n" and set(text) <= _TERMINATOR_CHARS:
+                self.terminators.append(token_id)
+        self._allowed = {}
+
+    def _accepts(self, kind, value, piece):
+        text = value + piece
+        # Exactly one separating space before the value, nothing more
+        if not text.startswith(" ") or text.startswith("  "):
+            return False
+        text = text[1:]
+        if kind == "float":
+            return _FLOAT_PREFIX.fullmatch(text) is not None
+        return any(allowed.startswith(text) for allowed in ALLOWED_VALUES[kind])
+
+    def allowed(self, kind, value):
+        """Token ids that keep ``value`` on track, plus terminators once it is finished.
+
+        A finished value that cannot grow (facet "2", "true") only allows a
+        terminator, so nothing like "2.5" or "13" gets past the mask. Should
+        no token fit at all, the value is closed rather than left unmasked.
+        """
+        key = (kind, value)
+        if key not in self._allowed:
+            stripped = value.strip()
+            if kind == "float":
+                finished = _FLOAT_VALUE.fullmatch(stripped) is not None
+            else:
+                finished = stripped in ALLOWED_VALUES[kind]
+            token_ids = [
+                token_id
+                for token_id, piece in self.candidates
+                if self._accepts(kind, value, piece)
+            ]
+            if finished or not token_ids:
+                token_ids += self.terminators
+            self._allowed[key] = torch.tensor(token_ids)
+        return self._allowed[key]
+
+    def mask(self, scores, row, kind, value):
+        """Restrict ``scores[row]`` in place to the tokens allowed next."""
+        allowed = self.allowed(kind, value).to(scores.device)
+        masked = torch.full_like(scores[row], float("-inf"))
+        masked[allowed] = scores[row, allowed]
+        scores[row] = masked
+
+
+class _SlotTracker:
+    """Follow generated JSON text far enough to know which value is being written."""
+
+    def __init__(self, kinds):
+        self.kinds = kinds
+        self.in_key = False
+        self.buffer = ""
+        self.key = None
+        self.value = None
+
+    def feed(self, text):
+        for ch in text:
+            if self.value is not None:
+                started = self.value.lstrip()
+                if started.startswith('"'):
+                    self.value += ch
+                    if ch == '"' and len(started) > 0 and not started.endswith("\\"):
+                        self.value = None
+                elif ch in ",}]" or (ch == "\n" and started):
+                    self.value = None
+                else:
+                    self.value += ch
+            elif self.in_key:
+                if ch == '"':
+                    self.in_key = False
+                    self.key = self.buffer
+                else:
+                    self.buffer += ch
+            elif ch == '"':
+                self.in_key = True
+                self.buffer = ""
+            elif ch == ":" and self.key in self.kinds:
+                self.value = ""
+
+    def slot(self):
+        """(kind, text so far) while inside a value slot, else None."""
+        if self.value is None:
+            return None
+        return self.kinds[self.key], self.value
+
+
+class SchemaLogitsProcessor(LogitsProcessor):
+    """Mask each row's logits to the values validate_schema would accept.
+
+    Facet slots only allow the digits 0-4, target slots only true/false and
+    the label slot only the three label strings. Outside value slots the
+    scores are left alone.
+    """
+
+    def __init__(self, tokenizer, vocabulary, prompt_length, fields=None):
+        self.tokenizer = tokenizer
+        self.vocabulary = vocabulary
+        self.kinds = slot_kinds(fields)
+        self.prompt_length = prompt_length
+        self.trackers = None
+        self.consumed = None  # Generated token ids each row's tracker has seen
+
+    def __call__(self, input_ids, scores):
+        if self.trackers is None:
+            self.trackers = [_SlotTracker(self.kinds) for _ in range(input_ids.shape[0])]
+            self.consumed = [[] for _ in range(input_ids.shape[0])]
+
+        generated = input_ids[:, self.prompt_length :].tolist()
+        scores = scores.clone()
+        for row, tokens in enumerate(generated):
+            consumed = self.consumed[row]
+            if tokens[: len(consumed)] != consumed:
+                # Assisted generation rolled back rejected draft tokens;
+                # replay the row from the start of the output
+                self.trackers[row] = _SlotTracker(self.kinds)
+                consumed.clear()
+            tracker = self.trackers[row]
+            for token_id in tokens[len(consumed) :]:
+                tracker.feed(self.tokenizer.decode([token_id], skip_special_tokens=True))
+            consumed[:] = tokens
+            slot = tracker.slot()
+            if slot is not None:
+                self.vocabulary.mask(scores, row, *slot)
+        return scores
+
+
+class SchemaForcedDecoder:
+    """Greedy decoder that only generates at the value slots of the schema.
+
+    Works on a whole batch at once: every row walks the same skeleton, and a
+    row that has finished its current value is fed masked padding until the
+    slowest row is done, so the KV cache stays aligned across rows.
+
+    With ``skip_below`` set, rows whose first float value (the overall
+    score) comes out below it get ``skip_sections`` filled with defaults
+    and leave the batch, so only the remaining rows decode those sections.
+    Rows that leave decode nothing more, so the skipped sections have to be
+    the last ones in the skeleton.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        skeleton=None,
+        vocabulary=None,
+        skip_below=None,
+        skip_sections=("targets",),
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.skeleton = skeleton or build_skeleton()
+        self.vocabulary = vocabulary  # A ValueVocabulary constrains each slot
+        self.segment_ids = [
+            tokenizer(part, add_special_tokens=False)["input_ids"]
+            if kind == "text"
+            else None
+            for kind, part in self.skeleton
+        ]
+        self.skip_below = skip_below
+        self.gate_field, self.gate_index = None, None
+        if skip_below is not None:
+            self._find_gate(skip_sections)
+
+    def _find_gate(self, skip_sections):
+        """Locate the score slot and the skeleton item where skipping starts."""
+        for index, (kind, part) in enumerate(self.skeleton):
+            if kind != "value":
+                continue
+            if self.gate_field is None and part[2] == "float":
+                self.gate_field = part
+            elif part[0] in skip_sections:
+                if self.gate_field is None:
+                    raise ValueError("Skipped sections must come after the score")
+                trailing = {item[0] for kind, item in self.skeleton[index:] if kind == "value"}
+                if not trailing <= set(skip_sections):
+                    raise ValueError(
+                        f"Skipped sections {tuple(skip_sections)} must end the skeleton; "
+                        f"{', '.join(sorted(trailing - set(skip_sections)))} would be defaulted too"
+                    )
+                # The text before the first skipped value opens its section
+                self.gate_index = index - 1
+                return
+        raise ValueError(f"None of {skip_sections} follow the score in the skeleton")
+
+    def _render_defaults(self, start):
+        """The rest of the skeleton from ``start`` with every value defaulted."""
+        return "".join(
+            part if kind == "text" else " " + VALUE_DEFAULTS[part[2]]
+            for kind, part in self.skeleton[start:]
+        )
+
+    def _select_rows(self, state, keep):
+        """Drop every batch row not in ``keep`` from the decode state."""
+        index = torch.tensor(keep, device=state["attention_mask"].device)
+        state["attention_mask"] = state["attention_mask"][index]
+        state["logits"] = state["logits"][index]
+        state["past_key_values"].batch_select_indices(index)
+
+    def _forward(self, state, input_ids, new_mask):
+        """Run new tokens through the model and keep the last logits per row.
+
+        ``new_mask`` is the attention mask for the new tokens. A row whose
+        last new token is masked padding keeps its previous logits.
+        """
+        attention_mask = torch.cat([state["attention_mask"], new_mask.long()], dim=1)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, -input_ids.shape[1] :],
+            past_key_values=state["past_key_values"],
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        logits = outputs.logits[:, -1, :]
+        if state["logits"] is not None:
+            fed = new_mask[:, -1].bool()
+            logits = torch.where(fed[:, None], logits, state["logits"])
+        state["attention_mask"] = attention_mask
+        state["past_key_values"] = outputs.past_key_values
+        state["logits"] = logits
+
+    def _feed_text(self, state, token_ids, batch_size, device):
+        input_ids = torch.tensor([token_ids] * batch_size, device=device)
+        self._forward(state, input_ids, torch.ones_like(input_ids))
+
+    def _decode_value(self, state, kind, batch_size, device):
+        """Greedily extend each row's value while it stays valid for ``kind``."""
+        values = [""] * batch_size
+        active = [True] * batch_size
+        for _ in range(MAX_VALUE_TOKENS):
+            logits = state["logits"]
+            if self.vocabulary is not None:
+                logits = logits.clone()
+                for row in range(batch_size):
+                    if active[row]:
+                        self.vocabulary.mask(logits, row, kind, values[row])
+            next_ids = logits.argmax(dim=-1).tolist()
+            for row, token_id in enumerate(next_ids):
+                if not active[row]:
+                    continue
+                piece = self.tokenizer.decode([token_id], skip_special_tokens=True)
+                if piece and is_value_prefix(kind, values[row] + piece):
+                    values[row] += piece
+                else:
+                    active[row] = False
+            if not any(active):
+                break
+            fed = torch.tensor(active, device=device)[:, None]
+            input_ids = torch.tensor(
+                [
+                    token_id if active[row] else self.tokenizer.pad_token_id
+                    for row, token_id in enumerate(next_ids)
+                ],
+                device=device,
+            )[:, None]
+            self._forward(state, input_ids, fed)
+
+        return [
+            " " + (value.strip() if is_complete_value(kind, value) else VALUE_DEFAULTS[kind])
+            for value in values
+        ]
+
+    @torch.no_grad()
+    def decode(self, inputs):
+        """Fill the skeleton for every row of a collated prompt batch.
+
+        ``inputs`` holds ``input_ids`` and ``attention_mask`` and optionally a
+        prefilled ``past_key_values`` covering the start of the prompt.
+        Returns the rendered JSON text per row.
+        """
+        input_ids = inputs["input_ids"]
+        batch_size, device = input_ids.shape[0], input_ids.device
+        past_key_values = inputs.get("past_key_values")
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        past_length = past_key_values.get_seq_length()
+
+        state = {
+            "attention_mask": inputs["attention_mask"][:, :past_length],
+            "past_key_values": past_key_values,
+            "logits": None,
+        }
+        self._forward(
+            state, input_ids[:, past_length:], inputs["attention_mask"][:, past_length:]
+        )
+
+        texts = [""] * batch_size
+        rows = list(range(batch_size))  # Original row of each live batch row
+        scores = None
+        for index, ((kind, part), segment_ids) in enumerate(zip(self.skeleton, self.segment_ids)):
+            if index == self.gate_index:
+                keep = [i for i, score in enumerate(scores) if score >= self.skip_below]
+                defaults = self._render_defaults(index)
+                for i, row in enumerate(rows):
+                    if i not in keep:
+                        texts[row] += defaults
+                if not keep:
+                    break
+                if len(keep) < len(rows):
+                    self._select_rows(state, keep)
+                    rows = [rows[i] for i in keep]
+
+            if kind == "text":
+                self._feed_text(state, segment_ids, len(rows), device)
+                for row in rows:
+                    texts[row] += part
+            else:
+                values = self._decode_value(state, part[2], len(rows), device)
+                if part == self.gate_field:
+                    scores = [float(value) for value in values]
+                for row, value in zip(rows, values):
+                    texts[row] += value
+        return texts
+
+
+class SchemaLikelihoodScorer:
+    """Read every value off one teacher-forced forward pass, no decode loop.
+
+    The skeleton is filled with placeholder values, in the leading-space
+    form the model emits them, and appended to each prompt; the model's
+    next-token distribution at each value slot then picks the value.
+    Enumerable kinds take the most likely allowed value. A float is the
+    expected value over its sign and digit tokens. Each slot is
+    conditioned on placeholders rather than on the values chosen before it,
+    which is the price of skipping the loop.
+    """
+
+    FLOAT_PLACEHOLDER = " -0.00"
+
+    def __init__(self, model, tokenizer, vocabulary, skeleton=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.skeleton = skeleton or build_skeleton()
+        self._digit_tables(vocabulary)
+
+        self.skeleton_ids = []
+        # (kind, read offsets, values, deciding token ids); a float slot keeps
+        # (id of the sign token, whether the space is its own token) in place
+        # of the deciding ids
+        self.slots = []
+        for kind, part in self.skeleton:
+            if kind == "text":
+                self.skeleton_ids += self._encode(part)
+                continue
+            start = len(self.skeleton_ids)
+            if part[2] == "float":
+                self.slots.append(self._float_slot(start))
+            else:
+                self.slots.append(self._choice_slot(part[2], start))
+        self.read_offsets = sorted({o for _, offsets, _, _ in self.slots for o in offsets})
+
+    def _encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _digit_tables(self, vocabulary):
+        """Token ids of single digits, all-digit pieces and spaced digits (" ", " 1")."""
+        single, leading, spaced = {}, {}, []
+        for token_id, piece in vocabulary.candidates:
+            if piece.isdigit():
+                leading[token_id] = int(piece[0])
+                if len(piece) == 1:
+                    single[token_id] = int(piece)
+            elif piece[:1] == " " and (piece[1:] == "" or piece[1:].isdigit()):
+                spaced.append(token_id)
+        self.single_ids = torch.tensor(list(single))
+        self.single_values = torch.tensor(list(single.values()), dtype=torch.float)
+        self.leading_ids = torch.tensor(list(leading))
+        self.leading_values = torch.tensor(list(leading.values()), dtype=torch.float)
+        self.spaced_ids = torch.tensor(spaced)
+
+    def _choice_slot(self, kind, start):
+        """Place the placeholder and find the token that tells the values apart."""
+        values = ALLOWED_VALUES[kind]
+        encoded = [self._encode(" " + value) for value in values]
+        shared = 0  # Leading tokens every value has in common (e.g. a quote)
+        while all(len(ids) > shared for ids in encoded) and len(
+            {ids[shared] for ids in encoded}
+        ) == 1:
+            shared += 1
+        deciding = [ids[shared] if len(ids) > shared else None for ids in encoded]
+        if None in deciding or len(set(deciding)) != len(values):
+            raise ValueError(f"The {kind} values cannot be told apart by one token")
+
+        placeholder = self._encode(" " + VALUE_DEFAULTS[kind])
+        self.skeleton_ids += placeholder
+        if placeholder[:shared] != encoded[0][:shared]:
+            raise ValueError(f"The {kind} placeholder does not share the values' prefix")
+        return kind, [start + shared - 1], values, deciding
+
+    def _float_slot(self, start):
+        """Place " -0.00" so the sign, integer and tenths distributions can be read.
+
+        The space is either its own token (" ", "-", "0", ".") or merged
+        into the sign (" -", "0", "."). Split, the token after the space
+        decides between "-" and a positive integer digit. Merged, " -" is
+        weighed against " " and " <digit>" right after the colon; a positive
+        integer part then has no read point of its own, so both signs use
+        the integer digit read after " -".
+        """
+        placeholder = self._encode(self.FLOAT_PLACEHOLDER)
+        pieces = [self.tokenizer.decode([token_id]) for token_id in placeholder]
+        if pieces[:4] == [" ", "-", "0", "."]:
+            split = True
+        elif pieces[:3] == [" -", "0", "."]:
+            split = False
+        else:
+            raise ValueError(f"Unexpected tokenization of {self.FLOAT_PLACEHOLDER!r}: {pieces}")
+        self.skeleton_ids += placeholder
+        sign = start + split  # Offset of the token holding "-"
+        # Before the sign: negative or positive; after it: the integer part;
+        # after ".": tenths
+        return "float", [sign - 1, sign, sign + 2], None, (placeholder[split], split)
+
+    @staticmethod
+    def _expected(probs, ids, values):
+        """Expected value over ``ids``, renormalized to those tokens alone."""
+        weights = probs[:, ids.to(probs.device)]
+        values = values.to(probs.device)
+        return (weights * values).sum(-1) / weights.sum(-1).clamp(min=1e-12)
+
+    def _float_values(self, sign_probs, integer_probs, tenths_probs, sign):
+        """Expected signed value, integer part plus tenths, per row."""
+        minus_id, split = sign
+        positive_ids = self.single_ids if split else self.spaced_ids
+        p_minus = sign_probs[:, minus_id]
+        p_positive = sign_probs[:, positive_ids.to(sign_probs.device)].sum(-1)
+        p_negative = p_minus / (p_minus + p_positive).clamp(min=1e-12)
+
+        tenths = self._expected(tenths_probs, self.leading_ids, self.leading_values) / 10
+        negative = self._expected(integer_probs, self.single_ids, self.single_values) + tenths
+        if split:
+            positive = self._expected(sign_probs, self.single_ids, self.single_values) + tenths
+        else:
+            positive = negative
+        return ((1 - p_negative) * positive - p_negative * negative).tolist()
+
+    @torch.no_grad()
+    def score(self, inputs):
+        """Fill the skeleton for every row of a collated prompt batch.
+
+        Takes the same ``inputs`` as SchemaForcedDecoder.decode() and returns
+        the rendered JSON text per row.
+        """
+        input_ids = inputs["input_ids"]
+        batch_size, device = input_ids.shape[0], input_ids.device
+        past_key_values = inputs.get("past_key_values")
+        past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+
+        new_ids = torch.cat(
+            [
+                input_ids[:, past_length:],
+                torch.tensor([self.skeleton_ids] * batch_size, device=device),
+            ],
+            dim=1,
+        )
+        skeleton_mask = torch.ones(
+            batch_size, len(self.skeleton_ids), dtype=torch.long, device=device
+        )
+        attention_mask = torch.cat([inputs["attention_mask"], skeleton_mask], dim=1)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        # Only the value slots need logits; skeleton offset o sits at column
+        # prompt_width + o of the new tokens
+        prompt_width = input_ids.shape[1] - past_length
+        columns = torch.tensor([prompt_width + o for o in self.read_offsets], device=device)
+        logits = self.model(
+            input_ids=new_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, -new_ids.shape[1] :],
+            past_key_values=past_key_values,
+            use_cache=past_key_values is not None,
+            logits_to_keep=columns,
+        ).logits.float()
+        probs = dict(zip(self.read_offsets, torch.softmax(logits, dim=-1).unbind(1)))
+
+        texts = [""] * batch_size
+        slots = iter(self.slots)
+        for kind, part in self.skeleton:
+            if kind == "text":
+                texts = [text + part for text in texts]
+                continue
+            slot_kind, offsets, values, deciding = next(slots)
+            if slot_kind == "float":
+                scores = self._float_values(*(probs[o] for o in offsets), deciding)
+                rendered = [f" {value:.2f}" for value in scores]
+            else:
+                choice = probs[offsets[0]][:, deciding].argmax(-1).tolist()
+                rendered = [" " + values[index] for index in choice]
+            texts = [text + value for text, value in zip(texts, rendered)]
+        return texts
@@ -5,6 +5,70 @@ INPUT_FILE = "./baseline_data/gemma_baseline_outputs.jsonl"
 OUTPUT_FILE = "./baseline_data/gemma_baseline_outputs_validated.jsonl"
 # =============================
 
+ALLOWED_LABELS = {"supportive", "neutral", "hateful"}
+
+FACETS_SCHEMA = [
+    "sentiment",
+    "respect",
+    "insult",
+    "humiliate",
+    "status",
+    "dehumanize",
+    "violence",
+    "genocide",
+    "attack_defend",
+    "hatespeech",
+]
+
+TARGETS_SCHEMA = [
+    "target_race_asian",
+    "target_race_black",
+    "target_race_latinx",
+    "target_race_middle_eastern",
+    "target_race_native_american",
+    "target_race_pacific_islander",
+    "target_race_white",
+    "target_race_other",
+    "target_religion_atheist",
+    "target_religion_buddhist",
+    "target_religion_christian",
+    "target_religion_hindu",
+    "target_religion_jewish",
+    "target_religion_mormon",
+    "target_religion_muslim",
+    "target_religion_other",
+    "target_origin_immigrant",
+    "target_origin_migrant_worker",
+    "target_origin_specific_country",
+    "target_origin_undocumented",
+    "target_origin_other",
+    "target_gender_men",
+    "target_gender_non_binary",
+    "target_gender_transgender_men",
+    "target_gender_transgender_unspecified",
+    "target_gender_transgender_women",
+    "target_gender_women",
+    "target_gender_other",
+    "target_sexuality_bisexual",
+    "target_sexuality_gay",
+    "target_sexuality_lesbian",
+    "target_sexuality_straight",
+    "target_sexuality_other",
+    "target_age_children",
+    "target_age_teenagers",
+    "target_age_young_adults",
+    "target_age_middle_aged",
+    "target_age_seniors",
+    "target_age_other",
+    "target_disability_physical",
+    "target_disability_cognitive",
+    "target_disability_neurological",
+    "target_disability_visually_impaired",
+    "target_disability_hearing_impaired",
+    "target_disability_unspecific",
+    "target_disability_other",
+]
+
 
 def clamp_int(value, min_val=0, max_val=4):
     """Round floats, clamp to range [0, 4], and ensure integer."""
@@ -15,11 +79,61 @@ def clamp_int(value, min_val=0, max_val=4):
     return max(min_val, min(max_val, int(value)))
 
 
+def derive_label(score):
+    """Label rules from SYSTEM_PROMPT."""
+    if score < -1:
+        return "supportive"
+    if score > 0.5:
+        return "hateful"
+    return "neutral"
+
+
+def is_compact(pred):
+    """Whether a prediction uses the compact {"s", "f", "t"} response format."""
+    return "facets" not in pred and any(key in pred for key in ("s", "f", "t"))
+
+
+def expand_compact(pred):
+    """Expand a compact response into the canonical nested schema.
+
+    Compact responses look like ``{"s": 1.47, "f": [4, 3, ...], "t": ["race_black"]}``:
+    the score, the facets as a list in FACETS_SCHEMA order, and only the
+    targets that are true, without their ``target_`` prefix. The label is
+    derived from the score.
+    """
+    try:
+        score = float(pred.get("s", 0.0))
+    except Exception:
+        score = 0.0
+
+    facets = pred.get("f")
+    if not isinstance(facets, list):
+        facets = []
+
+    true_targets = pred.get("t")
+    if not isinstance(true_targets, list):
+        true_targets = []
+    true_targets = {
+        name if name.startswith("target_") else f"target_{name}"
+        for name in true_targets
+        if isinstance(name, str)
+    }
+
+    return {
+        "overall": {"hate_speech_score": score, "label": derive_label(score)},
+        "facets": dict(zip(FACETS_SCHEMA, facets)),
+        "targets": {key: key in true_targets for key in TARGETS_SCHEMA},
+    }
+
+
 def validate_schema(entry):
     """Validate one prediction entry."""
     if entry.get("prediction") is None:
         entry["prediction"] = {}
 
+    if is_compact(entry["prediction"]):
+        entry["prediction"] = expand_compact(entry["prediction"])
+
     pred = entry["prediction"]
 
     # ========== OVERALL ==========
@@ -32,86 +146,25 @@ def validate_schema(entry):
     overall["hate_speech_score"] = score
 
     # Validate label
-    allowed_labels = {"supportive", "neutral", "hateful"}
     label = overall.get("label", "neutral")
-    if not isinstance(label, str) or label.lower() not in allowed_labels:
+    if not isinstance(label, str) or label.lower() not in ALLOWED_LABELS:
         label = "neutral"
     overall["label"] = label.lower()
 
     pred["overall"] = overall
 
     # ========== FACETS ==========
-    facets_schema = [
-        "sentiment",
-        "respect",
-        "insult",
-        "humiliate",
-        "status",
-        "dehumanize",
-        "violence",
-        "genocide",
-        "attack_defend",
-        "hatespeech",
-    ]
     facets = pred.get("facets", {})
     validated_facets = {}
-    for key in facets_schema:
+    for key in FACETS_SCHEMA:
         validated_facets[key] = clamp_int(facets.get(key, 0))
     pred["facets"] = validated_facets
 
     # ========== TARGETS ==========
     # All targets default to False
-    targets_schema = [
-        "target_race_asian",
-        "target_race_black",
-        "target_race_latinx",
-        "target_race_middle_eastern",
-        "target_race_native_american",
-        "target_race_pacific_islander",
-        "target_race_white",
-        "target_race_other",
-        "target_religion_atheist",
-        "target_religion_buddhist",
-        "target_religion_christian",
-        "target_religion_hindu",
-        "target_religion_jewish",
-        "target_religion_mormon",
-        "target_religion_muslim",
-        "target_religion_other",
-        "target_origin_immigrant",
-        "target_origin_migrant_worker",
-        "target_origin_specific_country",
-        "target_origin_undocumented",
-        "target_origin_other",
-        "target_gender_men",
-        "target_gender_non_binary",
-        "target_gender_transgender_men",
-        "target_gender_transgender_unspecified",
-        "target_gender_transgender_women",
-        "target_gender_women",
-        "target_gender_other",
-        "target_sexuality_bisexual",
-        "target_sexuality_gay",
-        "target_sexuality_lesbian",
-        "target_sexuality_straight",
-        "target_sexuality_other",
-        "target_age_children",
-        "target_age_teenagers",
-        "target_age_young_adults",
-        "target_age_middle_aged",
-        "target_age_seniors",
-        "target_age_other",
-        "target_disability_physical",
-        "target_disability_cognitive",
-        "target_disability_neurological",
-        "target_disability_visually_impaired",
-        "target_disability_hearing_impaired",
-        "target_disability_unspecific",
-        "target_disability_other",
-    ]
     targets = pred.get("targets", {})
     validated_targets = {}
-    for key in targets_schema:
+    for key in TARGETS_SCHEMA:
         val = targets.get(key, False)
         validated_targets[key] = bool(val) if isinstance(val, bool) else False
     pred["targets"] = validated_targets
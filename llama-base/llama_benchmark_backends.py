@@ -0,0 +1,123 @@
+"""Compare the local CPU backends on speed, memory and accuracy.
+
+Each backend runs llama_inference_base.py in its own process (BACKEND is
+read at import, when the model loads), so peak RSS is that process's own
+maximum as reported by the kernel. The outputs are validated and scored with
+llama_evaluation, and every backend is reported against fp32.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+RUNNER = "llama_inference_base"
+BACKENDS = ("fp32", "bf16", "int8")
+SAMPLES = 100  # First N test samples per backend
+OUTPUT_DIR = "./llama_outputs/backend_benchmark"
+REPORT_FILE = "./llama_outputs/backend_benchmark/report.txt"
+
+
+def run_child(backend, output_file):
+    """Child process: run inference for one backend and write its timings."""
+    runner = __import__(RUNNER)
+    runner.OUTPUT_FILE = output_file
+    runner.RESUME = False
+    runner.USE_PREDICTION_CACHE = False  # Every backend must really generate
+
+    # Count the new non-padding tokens every generate() call produces
+    generate = runner.model.generate
+    generated = {"tokens": 0}
+
+    def counting_generate(**kwargs):
+        outputs = generate(**kwargs)
+        new_tokens = outputs[:, kwargs["input_ids"].shape[1] :]
+        generated["tokens"] += int((new_tokens != runner.tokenizer.pad_token_id).sum())
+        return outputs
+
+    runner.model.generate = counting_generate
+
+    entries = runner.load_data(runner.TEST_FILE)[:SAMPLES]
+    start = time.perf_counter()
+    runner.run_inference(entries)
+    elapsed = time.perf_counter() - start
+
+    with open(output_file + ".stats.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {"samples": len(entries), "seconds": elapsed, "tokens": generated["tokens"]}, f
+        )
+
+
+def benchmark(backend):
+    """Run one backend in a fresh process and collect speed, memory and metrics."""
+    from llama_evaluation import TEST_FILE, evaluate
+    from llama_validate_schema import validate_file
+
+    output_file = os.path.join(OUTPUT_DIR, f"{backend}.jsonl")
+    validated_file = os.path.join(OUTPUT_DIR, f"{backend}_validated.jsonl")
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--child", backend, "--output", output_file],
+        env={**os.environ, "BACKEND": backend},
+    )
+    # wait4 hands back the child's rusage; ru_maxrss is in KiB on Linux
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{backend} run exited with code {process.returncode}")
+
+    with open(output_file + ".stats.json", "r", encoding="utf-8") as f:
+        stats = json.load(f)
+    validate_file(output_file, validated_file)
+    return {
+        "backend": backend,
+        "samples_per_sec": stats["samples"] / stats["seconds"],
+        "tokens_per_sec": stats["tokens"] / stats["seconds"] if stats["tokens"] else None,
+        "peak_rss_mib": usage.ru_maxrss / 1024,
+        "metrics": evaluate(TEST_FILE, validated_file),
+    }
+
+
+def format_report(results):
+    baseline = next((r for r in results if r["backend"] == "fp32"), results[0])
+    lines = [f"Backend benchmark on the first {SAMPLES} test samples (vs {baseline['backend']})", ""]
+    for result in results:
+        tokens = result["tokens_per_sec"]
+        lines.append(f"=== {result['backend'].upper()} ===")
+        lines.append(f"Samples/sec: {result['samples_per_sec']:.3f}")
+        lines.append(f"Tokens/sec: {tokens:.1f}" if tokens else "Tokens/sec: n/a")
+        lines.append(f"Peak RSS: {result['peak_rss_mib']:.0f} MiB")
+        reference = baseline["metrics"] or {}
+        for name, value in (result["metrics"] or {}).items():
+            if isinstance(value, int):
+                lines.append(f"{name}: {value} ({value - reference.get(name, 0):+d})")
+            else:
+                lines.append(f"{name}: {value:.4f} ({value - reference.get(name, 0.0):+.4f})")
+        if not result["metrics"]:
+            lines.append("No valid predictions to score")
+        lines.append("")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local CPU backends")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS))
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.output)
+        return
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    results = [benchmark(backend) for backend in args.backends]
+    lines = format_report(results)
+    with open(REPORT_FILE, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    print("\n".join(lines))
+    print(f"Report written to {REPORT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
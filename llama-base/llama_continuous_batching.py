@@ -0,0 +1,189 @@
+"""Iteration-level continuous batching around a Hugging Face causal LM.
+
+Static batches hold every row until the slowest one finishes. Here each
+decode step runs one token for every live row; a row whose JSON object has
+closed (or that hit EOS or its token limit) leaves the batch right away and
+the next queued prompt is prefilled on its own and spliced into the freed
+slot. This is the scheduling vLLM does, on plain transformers and CPU.
+
+Rows keep their own stretch of the batched KV cache: a new row is
+left-padded (or the batch is) to a common length and the padding is masked
+out, so every row attends only to its own prompt and output.
+"""
+import copy
+from collections import deque
+
+import torch
+from transformers import DynamicCache
+
+from llama_json_stopping import JsonBraceTracker
+
+
+def _left_pad(legacy, width):
+    """Left-pad every cached key/value tensor to ``width`` positions with zeros."""
+    padded = []
+    for keys, values in legacy:
+        extra = width - keys.shape[2]
+        if extra:
+            keys = torch.nn.functional.pad(keys, (0, 0, extra, 0))
+            values = torch.nn.functional.pad(values, (0, 0, extra, 0))
+        padded.append((keys, values))
+    return padded
+
+
+class _Row:
+    """One live sequence: its key, output so far and stop state."""
+
+    def __init__(self, key, processor):
+        self.key = key
+        self.generated = []
+        self.processor = processor
+        self.tracker = JsonBraceTracker()
+
+
+class ContinuousBatcher:
+    """Greedy decoding with rows joining and leaving at every step.
+
+    ``make_processor`` optionally returns a fresh logits processor per row;
+    it is called with that row's generated ids only (shape ``[1, n]``), so
+    it must treat position 0 as the first generated token. ``prefix_cache``
+    is a batch-1 cache for a prompt prefix every request shares; requests
+    then carry only the ids after it.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        max_slots=8,
+        max_new_tokens=1024,
+        stop_on_json_close=True,
+        make_processor=None,
+        prefix_cache=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_slots = max_slots
+        self.max_new_tokens = max_new_tokens
+        self.stop_on_json_close = stop_on_json_close
+        self.make_processor = make_processor
+        self.prefix_cache = prefix_cache
+        self.device = model.device
+
+    def _next_token(self, row, logits):
+        """Pick the row's next token and report whether the row is done."""
+        if row.processor is not None:
+            generated = torch.tensor([row.generated], dtype=torch.long, device=self.device)
+            logits = row.processor(generated, logits[None, :])[0]
+        token_id = int(logits.argmax())
+        if token_id == self.tokenizer.eos_token_id:
+            return None, True
+        row.generated.append(token_id)
+        piece = self.tokenizer.decode([token_id], skip_special_tokens=True)
+        closed = row.tracker.feed(piece) and self.stop_on_json_close
+        return token_id, closed or len(row.generated) >= self.max_new_tokens
+
+    def _prefill(self, token_ids):
+        """Run one prompt alone; return its cache and last-position logits."""
+        if self.prefix_cache is not None:
+            cache = copy.deepcopy(self.prefix_cache)
+        else:
+            cache = DynamicCache()
+        outputs = self.model(
+            input_ids=torch.tensor([token_ids], device=self.device),
+            past_key_values=cache,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        return outputs.past_key_values, outputs.logits[0, -1]
+
+    def _splice(self, batch, row_cache):
+        """Add a prefilled row to the batch cache, aligned at the right edge."""
+        if batch["cache"] is None:
+            width = row_cache.get_seq_length()
+            batch["cache"] = row_cache
+            batch["mask"] = torch.ones(1, width, dtype=torch.long, device=self.device)
+            return
+
+        old, new = batch["cache"].to_legacy_cache(), row_cache.to_legacy_cache()
+        old_width, new_width = old[0][0].shape[2], new[0][0].shape[2]
+        width = max(old_width, new_width)
+        old, new = _left_pad(old, width), _left_pad(new, width)
+        batch["cache"] = DynamicCache.from_legacy_cache(
+            tuple(
+                (torch.cat([ok, nk]), torch.cat([ov, nv]))
+                for (ok, ov), (nk, nv) in zip(old, new)
+            )
+        )
+        mask = torch.nn.functional.pad(batch["mask"], (width - old_width, 0))
+        row_mask = torch.zeros(1, width, dtype=torch.long, device=self.device)
+        row_mask[:, width - new_width:] = 1
+        batch["mask"] = torch.cat([mask, row_mask])
+
+    def _evict(self, batch, keep):
+        """Keep only the rows at ``keep`` and trim columns no row still uses."""
+        index = torch.tensor(keep, device=self.device)
+        batch["mask"] = batch["mask"][index]
+        batch["cache"].batch_select_indices(index)
+        used = batch["mask"].any(dim=0).nonzero()
+        start = int(used[0]) if len(used) else 0
+        if start:
+            legacy = batch["cache"].to_legacy_cache()
+            batch["cache"] = DynamicCache.from_legacy_cache(
+                tuple((keys[:, :, start:], values[:, :, start:]) for keys, values in legacy)
+            )
+            batch["mask"] = batch["mask"][:, start:]
+
+    @torch.no_grad()
+    def run(self, requests):
+        """Decode ``(key, token_ids)`` requests, yielding ``(key, generated_ids)``.
+
+        Results come out in completion order, not request order.
+        """
+        queue = deque(requests)
+        rows, pending = [], []  # Live rows and the token each feeds next
+        batch = {"cache": None, "mask": None}
+
+        while queue or rows:
+            while queue and len(rows) < self.max_slots:
+                key, token_ids = queue.popleft()
+                processor = self.make_processor() if self.make_processor else None
+                row = _Row(key, processor)
+                row_cache, logits = self._prefill(token_ids)
+                token_id, done = self._next_token(row, logits)
+                if done:
+                    yield row.key, row.generated
+                    continue
+                self._splice(batch, row_cache)
+                rows.append(row)
+                pending.append(token_id)
+            if not rows:
+                continue
+
+            batch["mask"] = torch.nn.functional.pad(batch["mask"], (0, 1), value=1)
+            position_ids = batch["mask"].sum(dim=-1, keepdim=True) - 1
+            outputs = self.model(
+                input_ids=torch.tensor(pending, device=self.device)[:, None],
+                attention_mask=batch["mask"],
+                position_ids=position_ids,
+                past_key_values=batch["cache"],
+                use_cache=True,
+            )
+            batch["cache"] = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+
+            keep, next_pending = [], []
+            for index, row in enumerate(rows):
+                token_id, done = self._next_token(row, logits[index])
+                if done:
+                    yield row.key, row.generated
+                else:
+                    keep.append(index)
+                    next_pending.append(token_id)
+            if len(keep) < len(rows):
+                rows = [rows[index] for index in keep]
+                if rows:
+                    self._evict(batch, keep)
+                else:
+                    batch = {"cache": None, "mask": None}
+            pending = next_pending
@@ -0,0 +1,171 @@
+"""Spread local inference over several CPU worker processes.
+
+A single PyTorch process leaves most cores of a large machine idle, and
+handing it every core scales poorly. Instead the entries are cut into
+contiguous shards, one per worker process with its own torch.set_num_threads
+budget, and the shard outputs are merged back in order. autotune() times a
+few workers x threads splits on a sample and picks the fastest.
+
+With the "fork" start method the workers are forked from the runner after
+it has loaded the model, so they all read the parent's weight pages
+copy-on-write instead of each loading a copy; the per-worker PSS printed at
+the end shows how much memory is really private.
+"""
+import gc
+import multiprocessing
+import os
+import queue
+
+
+def available_cores():
+    """Cores this process may run on (respects taskset/cgroup affinity)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def split_shards(entries, workers):
+    """Cut ``entries`` into ``workers`` contiguous shards of near-equal size."""
+    size, extra = divmod(len(entries), workers)
+    shards, start = [], 0
+    for k in range(workers):
+        end = start + size + (1 if k < extra else 0)
+        shards.append(entries[start:end])
+        start = end
+    return shards
+
+
+def candidate_splits(cores):
+    """(workers, threads) pairs that fill ``cores``: powers of two plus one per core."""
+    splits = []
+    workers = 1
+    while workers <= cores:
+        splits.append((workers, cores // workers))
+        workers *= 2
+    if splits[-1][0] != cores:
+        splits.append((cores, 1))
+    return splits
+
+
+def process_memory():
+    """Resident and proportional set size of this process in MiB (Linux only).
+
+    PSS splits each shared page between the processes mapping it, so summing
+    PSS over the workers gives their real combined footprint.
+    """
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                if name in ("Rss", "Pss"):
+                    memory[name.lower()] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return memory
+
+
+def _call(results, index, fn, args):
+    result = fn(*args)
+    results.put((index, result, process_memory()))
+
+
+def run_workers(fn, args_list, start_method="spawn"):
+    """Call ``fn(*args)`` in one worker process per tuple; results in order.
+
+    With "spawn" each child imports the runner (and loads its own model), so
+    ``fn`` must be a module-level function. With "fork" the children start
+    as copies of this process and share its loaded weights copy-on-write.
+    If any worker dies the rest are terminated and RuntimeError is raised.
+    """
+    ctx = multiprocessing.get_context(start_method)
+    if start_method == "fork":
+        # Keep the collector from writing to every inherited object (and
+        # so copying its page) when it runs in a child
+        gc.collect()
+        gc.freeze()
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_call, args=(results, index, fn, args))
+        for index, args in enumerate(args_list)
+    ]
+    for process in processes:
+        process.start()
+
+    collected, memory = {}, {}
+    while len(collected) < len(processes):
+        try:
+            index, result, memory[index] = results.get(timeout=1)
+            collected[index] = result
+        except queue.Empty:
+            failed = [p for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise RuntimeError(f"Worker process exited with code {failed[0].exitcode}")
+
+    for process in processes:
+        process.join()
+    if start_method == "fork":
+        gc.unfreeze()
+
+    if all(memory.values()):
+        for index in range(len(processes)):
+            print(
+                f"Worker {index}: RSS {memory[index]['rss']:.0f} MiB, "
+                f"PSS {memory[index]['pss']:.0f} MiB"
+            )
+        print(f"Workers' combined PSS: {sum(m['pss'] for m in memory.values()):.0f} MiB")
+    return [collected[index] for index in range(len(processes))]
+
+
+def merge_shards(shard_paths, output_file):
+    """Append the shard files to ``output_file`` in shard order, then delete them."""
+    with open(output_file, "a", encoding="utf-8") as out:
+        for path in shard_paths:
+            with open(path, "r", encoding="utf-8") as f:
+                out.write(f.read())
+        out.flush()
+        os.fsync(out.fileno())
+    for path in shard_paths:
+        os.remove(path)
+
+
+def run_sharded(run_fn, entries, workers, threads, output_file, start_method="spawn"):
+    """Run ``run_fn(shard, shard_path, threads)`` per worker and merge the outputs.
+
+    Shard files sit next to ``output_file`` until the merge, so an
+    interrupted run resumes per shard when restarted with the same split.
+    """
+    shards = split_shards(entries, workers)
+    shard_paths = [f"{output_file}.shard{k}" for k in range(workers)]
+    print(f"Running {len(entries)} samples on {workers} workers x {threads} threads")
+    run_workers(
+        run_fn,
+        [(shard, path, threads) for shard, path in zip(shards, shard_paths)],
+        start_method,
+    )
+    merge_shards(shard_paths, output_file)
+
+
+def autotune(time_fn, sample, cores=None, start_method="spawn"):
+    """Time each candidate split on ``sample``; return the fastest (workers, threads).
+
+    ``time_fn(shard, threads)`` runs inside each worker and returns the
+    seconds spent predicting its shard, so model loading is not counted.
+    """
+    cores = cores or available_cores()
+    best = None
+    for workers, threads in candidate_splits(cores):
+        if workers > len(sample):
+            continue
+        shards = split_shards(sample, workers)
+        elapsed = max(
+            run_workers(time_fn, [(shard, threads) for shard in shards], start_method)
+        )
+        rate = len(sample) / elapsed
+        print(f"Autotune: {workers} workers x {threads} threads -> {rate:.2f} samples/s")
+        if best is None or rate > best[0]:
+            best = (rate, workers, threads)
+    print(f"Autotune picked {best[1]} workers x {best[2]} threads")
+    return best[1], best[2]
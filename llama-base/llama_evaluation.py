@@ -13,9 +13,23 @@ def load_jsonl(path):
         return [json.loads(line) for line in f]
 
 
-def main():
-    gold = load_jsonl(TEST_FILE)
-    preds = load_jsonl(OUTPUT_FILE)
+def score_to_label(score):
+    """Label a score with the thresholds the annotations use."""
+    if score > 0.5:
+        return "hateful"
+    if score < -1:
+        return "supportive"
+    return "neutral"
+
+
+def evaluate(test_file, predictions_file):
+    """Score a validated predictions file against the gold test set.
+
+    Returns a dict of metrics (``valid`` counts the predictions scored), or
+    None when there is nothing valid to score.
+    """
+    gold = load_jsonl(test_file)
+    preds = load_jsonl(predictions_file)
 
     gold_data, model_outputs = [], []
     for p in preds:
@@ -30,9 +44,7 @@ def main():
     if len(model_outputs) == 0:
         print("No valid predictions found! Check your inference results.")
         print("This usually means the model failed to generate valid JSON responses.")
-        return
-
-    lines = []
+        return None
 
     # === OVERALL ===
     y_true = [x["overall"]["hate_speech_score"] for x in gold_data]
@@ -40,12 +52,15 @@ def main():
         x["overall"].get("hate_speech_score", x["overall"].get("score"))
         for x in model_outputs
     ]
-    mae = mean_absolute_error(y_true, y_pred)
-    corr = spearmanr(y_true, y_pred).correlation
+    overall_mae = mean_absolute_error(y_true, y_pred)
+    overall_corr = spearmanr(y_true, y_pred).correlation
+    label_macro_f1 = f1_score(
+        [x["overall"]["label"] for x in gold_data],
+        [score_to_label(score) for score in y_pred],
+        average="macro",
+        zero_division=0,
+    )
 
-    lines.append("=== OVERALL ===")
-    lines.append(f"MAE: {mae:.4f}")
-    lines.append(f"Spearman: {corr:.4f}\n")
 
     # === FACETS ===
     facet_names = gold_data[0]["facets"].keys()
@@ -65,9 +80,6 @@ def main():
             print(f"Error calculating correlation for {f}: {e}")
             facet_corr[f] = 0.0
 
-    lines.append("=== FACETS ===")
-    lines.append(f"Mean MAE: {np.mean(list(facet_mae.values())):.4f}")
-    lines.append(f"Mean Spearman: {np.mean(list(facet_corr.values())):.4f}\n")
 
     # === TARGETS ===
     target_names = gold_data[0]["targets"].keys()
@@ -81,9 +93,36 @@ def main():
     micro_f1 = f1_score(y_true, y_pred, average="micro", zero_division=0)
     macro_f1_targets = f1_score(y_true, y_pred, average="macro", zero_division=0)
 
+    return {
+        "valid": len(model_outputs),
+        "score_mae": overall_mae,
+        "score_spearman": overall_corr,
+        "label_macro_f1": label_macro_f1,
+        "facet_mae": np.mean(list(facet_mae.values())),
+        "facet_spearman": np.mean(list(facet_corr.values())),
+        "target_micro_f1": micro_f1,
+        "target_macro_f1": macro_f1_targets,
+    }
+
+
+def main():
+    metrics = evaluate(TEST_FILE, OUTPUT_FILE)
+    if metrics is None:
+        return
+
+    lines = []
+    lines.append("=== OVERALL ===")
+    lines.append(f"MAE: {metrics['score_mae']:.4f}")
+    lines.append(f"Spearman: {metrics['score_spearman']:.4f}")
+    lines.append(f"Label Macro F1 (from score): {metrics['label_macro_f1']:.4f}\n")
+
+    lines.append("=== FACETS ===")
+    lines.append(f"Mean MAE: {metrics['facet_mae']:.4f}")
+    lines.append(f"Mean Spearman: {metrics['facet_spearman']:.4f}\n")
+
     lines.append("=== TARGETS ===")
-    lines.append(f"Micro F1: {micro_f1:.4f}")
-    lines.append(f"Macro F1: {macro_f1_targets:.4f}\n")
+    lines.append(f"Micro F1: {metrics['target_micro_f1']:.4f}")
+    lines.append(f"Macro F1: {metrics['target_macro_f1']:.4f}\n")
 
     lines.append("✅ Evaluation complete.\n")
 
@@ -1,16 +1,61 @@
-import json, os
+import argparse, copy, json, os, time
 from tqdm import tqdm
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    DynamicCache,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+)
 import re
 
+from llama_batch_scheduler import fixed_batches, padding_ratio, plan_batches
+from llama_continuous_batching import ContinuousBatcher
+from llama_cpu_sharding import autotune, available_cores, run_sharded
+from llama_json_stopping import JsonBraceTracker, JsonObjectStoppingCriteria
+from llama_pipeline import StagedPipeline
+from llama_prediction_cache import PredictionCache, model_fingerprint
+from llama_prompt_assembly import PromptAssembler, first_mismatch
+from llama_schema_decoding import (
+    SchemaForcedDecoder,
+    SchemaLikelihoodScorer,
+    SchemaLogitsProcessor,
+    ValueVocabulary,
+    schema_fields,
+)
+
 # ==============================
 # CONFIG
 MODEL_NAME = "meta-llama/Llama-3.2-1B-Instruct"
 TEST_FILE = "../data/test.jsonl"
 OUTPUT_FILE = "./llama_outputs/llama_baseline_outputs.jsonl"
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+BACKENDS = ("default", "fp32", "bf16", "int8")
+BACKEND = os.getenv("BACKEND", "default")  # "default" keeps bf16 with device_map="auto"; the others run on CPU
+DEVICE = "cuda" if torch.cuda.is_available() and BACKEND == "default" else "cpu"
 BATCH_SIZE = 5
+USE_PREFIX_CACHE = True  # Prefill the instruction block once and reuse its KV cache
+PRETOKENIZED_PROMPTS = True  # Tokenize only the comments and splice them into the pre-tokenized template
+VERIFY_PROMPT_SAMPLES = 32  # Pending samples checked against the full template path first (0 skips)
+TOKEN_BUDGET = 4096  # Max padded prompt tokens per batch; None keeps fixed BATCH_SIZE chunks
+MAX_BATCH_SIZE = 32  # Cap on rows per length-bucketed batch
+STOP_ON_JSON_CLOSE = True  # End each row once its top-level JSON object closes
+PARALLEL_FIELD_GROUPS = False  # Generate mode: decode overall/facets/targets as parallel rows off one prefill
+CONTINUOUS_BATCHING = False  # Generate mode: finished rows leave every step and queued samples take their slot (MAX_BATCH_SIZE slots)
+DECODING_MODE = "generate"  # "generate" (free-form), "schema" (only values are generated) or "score" (one forward pass)
+CONSTRAIN_VALUES = True  # Mask value tokens to the types validate_schema enforces
+CONDITIONAL_THRESHOLD = None  # Schema mode: a score below this fills CONDITIONAL_SECTIONS with defaults
+CONDITIONAL_SECTIONS = ("targets",)  # Trailing sections only; add "facets" to skip those too
+RESPONSE_FORMAT = "full"  # "full" schema or "compact" ({"s", "f", "t"}, expanded by validate_schema)
+RESUME = False  # Skip comment_ids already in OUTPUT_FILE; only for reruns with the same config
+PIPELINED = True  # Prepare, generate, parse and write batches on separate threads
+PARSE_WORKERS = 2  # Threads parsing model output when PIPELINED
+PIPELINE_QUEUE_SIZE = 4  # Batches each pipeline queue holds before its producer waits
+MAX_NEW_TOKENS = 1024
+PROMPT_LOOKUP_NUM_TOKENS = None  # e.g. 10: draft tokens from matching prompt n-grams (generate mode, one row at a time)
+USE_PREDICTION_CACHE = True  # Reuse predictions made before under the exact same configuration
+PREDICTION_CACHE_PATH = "../prediction_cache.sqlite"  # Shared by every runner
+AUTOTUNE_SAMPLES = 16  # Samples timed per workers x threads split by --workers auto
 SAMPLE_LIMIT = None  # Set to None to process all samples
 # ==============================
 
@@ -139,12 +184,84 @@ TEXT TO ANALYZE
 
 Return ONLY the JSON object. Do not say anything else."""
 
+COMPACT_SYSTEM_PROMPT = """You are an expert hate speech analyst. Your task is to analyze the provided text and return ONLY a compact JSON object in the format below. Do not include explanations, markdown, or any other text outside of the JSON object.
+
+=========================
+OUTPUT FORMAT
+=========================
+{"s": <score>, "f": [<10 facet integers>], "t": [<targeted groups>]}
+
+=========================
+FIELDS
+=========================
+"s" → a single signed float (a standard JSON number, not a string):
+  - NEGATIVE float for supportive content → e.g. `-1.35`
+  - POSITIVE float for hateful content → e.g. `1.47`
+  - NEAR ZERO float for neutral content → e.g. `0.12`, `-0.08`
+
+"f" → exactly 10 **integers** from 0 to 4, one per facet, in this order:
+  sentiment, respect, insult, humiliate, status, dehumanize, violence,
+  genocide, attack_defend, hatespeech
+  Scale: 0 = Absent, 1 = Mild, 2 = Clear, 3 = Severe, 4 = Extreme
+
+"t" → the groups that are explicitly targeted, using only names from this
+list. Use `[]` when no group is targeted:
+  race_asian, race_black, race_latinx, race_middle_eastern,
+  race_native_american, race_pacific_islander, race_white, race_other,
+  religion_atheist, religion_buddhist, religion_christian, religion_hindu,
+  religion_jewish, religion_mormon, religion_muslim, religion_other,
+  origin_immigrant, origin_migrant_worker, origin_specific_country,
+  origin_undocumented, origin_other, gender_men, gender_non_binary,
+  gender_transgender_men, gender_transgender_unspecified,
+  gender_transgender_women, gender_women, gender_other, sexuality_bisexual,
+  sexuality_gay, sexuality_lesbian, sexuality_straight, sexuality_other,
+  age_children, age_teenagers, age_young_adults, age_middle_aged, age_seniors,
+  age_other, disability_physical, disability_cognitive,
+  disability_neurological, disability_visually_impaired,
+  disability_hearing_impaired, disability_unspecific, disability_other
+
+Example: {"s": 1.47, "f": [4, 4, 3, 3, 2, 1, 0, 0, 3, 3], "t": ["race_black"]}
+
+=========================
+TEXT TO ANALYZE
+=========================
+{text}
+
+Return ONLY the JSON object. Do not say anything else."""
+
 # --------------------------
 # Load Model & Tokenizer
 # --------------------------
-print("Loading Llama model and tokenizer...")
+def load_model(backend):
+    """Load the model for one of BACKENDS.
+
+    "int8" swaps every nn.Linear (lm_head included) for a dynamically
+    quantized one: int8 weights, activations quantized per batch on the fly.
+    PyTorch's dynamic quantization only takes fp32 activations, so bf16
+    activations are a separate backend rather than an int8 option.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown BACKEND {backend!r}; expected one of {BACKENDS}")
+    if backend == "default":
+        return AutoModelForCausalLM.from_pretrained(
+            MODEL_NAME, torch_dtype=torch.bfloat16, device_map="auto"
+        )
+    if backend == "bf16":
+        return AutoModelForCausalLM.from_pretrained(MODEL_NAME, torch_dtype=torch.bfloat16)
+    model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, torch_dtype=torch.float32)
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    return model
+
+
+print(f"Loading Llama model and tokenizer ({BACKEND} backend)...")
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, torch_dtype=torch.bfloat16, device_map="auto")
+tokenizer.padding_side = "left"  # batched generate needs prompts right-aligned
+if tokenizer.pad_token is None:
+    tokenizer.pad_token = tokenizer.eos_token  # Llama ships without a pad token
+model = load_model(BACKEND)
 model.eval()
 print(f"Device: {model.device}")
 
@@ -190,38 +307,165 @@ def extract_json(text: str):
         return None
 
 
-def analyze(entry):
+def build_prompt(entry):
+    prompt_template = COMPACT_SYSTEM_PROMPT if RESPONSE_FORMAT == "compact" else SYSTEM_PROMPT
+
     # Build a chat conversation for the instruction-tuned model
     chat = [
         {"role": "system", "content": "You are an expert hate speech analyst."},
-        {"role": "user", "content": SYSTEM_PROMPT.replace("{text}", entry["text"])},
+        {"role": "user", "content": prompt_template.replace("{text}", entry["text"])},
     ]
 
     # Apply the chat template to format the conversation
-    prompt = tokenizer.apply_chat_template(
+    return tokenizer.apply_chat_template(
         chat, tokenize=False, add_generation_prompt=True
     )
 
-    # Tokenize and run inference
-    inputs = tokenizer(
-        prompt, return_tensors="pt", truncation=True, max_length=2048
-    ).to(DEVICE)
 
-    with torch.no_grad():
-        outputs = model.generate(
-            **inputs,
-            max_new_tokens=1024,
-            do_sample=False,
-            eos_token_id=tokenizer.eos_token_id,
+# --------------------------
+# Shared Prompt Prefix
+# --------------------------
+_prompt_prefix = None
+
+
+def get_prompt_prefix():
+    """Prefill the chat-templated prompt up to ``{text}`` once per model.
+
+    Returns a dict with the prefix string, its token ids and the
+    past_key_values produced by running it through the model.
+    """
+    global _prompt_prefix
+    if _prompt_prefix is None:
+        rendered = build_prompt({"text": "{text}"})
+        prefix_text = rendered[: rendered.index("{text}")]
+        prefix_ids = tokenizer(prefix_text, return_tensors="pt")["input_ids"].to(DEVICE)
+        with torch.no_grad():
+            outputs = model(
+                input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True
+            )
+        _prompt_prefix = {
+            "text": prefix_text,
+            "input_ids": prefix_ids[0].tolist(),
+            "past_key_values": outputs.past_key_values,
+        }
+    return _prompt_prefix
+
+
+def expand_prefix_cache(past_key_values, batch_size):
+    """Copy the cached prefix so generate() can extend it, one row per sample."""
+    past_key_values = copy.deepcopy(past_key_values)
+    if batch_size > 1:
+        past_key_values.batch_repeat_interleave(batch_size)
+    return past_key_values
+
+
+def splice_prefix(prefix_ids, suffix_ids):
+    """Join the shared prefix with each suffix, padding between the two.
+
+    The prefix stays at the same positions in every row so the cached keys
+    and values line up; the padding is masked out instead.
+    """
+    width = max(len(ids) for ids in suffix_ids)
+    input_ids, attention_mask = [], []
+    for ids in suffix_ids:
+        pad = width - len(ids)
+        input_ids.append(prefix_ids + [tokenizer.pad_token_id] * pad + ids)
+        attention_mask.append([1] * len(prefix_ids) + [0] * pad + [1] * len(ids))
+    return {
+        "input_ids": torch.tensor(input_ids, device=DEVICE),
+        "attention_mask": torch.tensor(attention_mask, device=DEVICE),
+    }
+
+
+_prompt_assembler = None
+
+
+def get_prompt_assembler():
+    """Pre-tokenize the template around ``{text}`` once per model."""
+    global _prompt_assembler
+    if _prompt_assembler is None:
+        _prompt_assembler = PromptAssembler(tokenizer, build_prompt({"text": "{text}"}))
+    return _prompt_assembler
+
+
+def render_token_ids(entries):
+    """tokenize_entries() the slow way: render and tokenize every prompt whole.
+
+    Truncation is done by slicing (the same as ``truncation=True`` on one
+    sequence) so that the shared fast tokenizer is never reconfigured while
+    the model thread decodes with it.
+    """
+    prompts = [build_prompt(entry) for entry in entries]
+
+    if not USE_PREFIX_CACHE:
+        return [ids[:2048] for ids in tokenizer(prompts)["input_ids"]]
+
+    prefix = get_prompt_prefix()
+    suffixes = []
+    for prompt in prompts:
+        if not prompt.startswith(prefix["text"]):
+            raise ValueError("Chat template output does not start with the cached prefix")
+        suffixes.append(prompt[len(prefix["text"]):])
+
+    # Only the comment and the closing instructions still need prefilling
+    max_length = 2048 - len(prefix["input_ids"])
+    return [ids[:max_length] for ids in tokenizer(suffixes, add_special_tokens=False)["input_ids"]]
+
+
+def tokenize_entries(entries):
+    """Token ids that still need prefilling for each entry.
+
+    With the prefix cache on this is just the comment suffix; otherwise it
+    is the whole chat-templated prompt.
+    """
+    if not PRETOKENIZED_PROMPTS:
+        return render_token_ids(entries)
+
+    assembler = get_prompt_assembler()
+    texts = [entry["text"] for entry in entries]
+    if not USE_PREFIX_CACHE:
+        token_ids = assembler.token_ids(texts, max_length=2048)
+    else:
+        token_ids = assembler.token_ids(
+            texts,
+            include_head=False,
+            max_length=2048 - len(get_prompt_prefix()["input_ids"]),
         )
 
-    # Decode generated text
-    text_output = tokenizer.decode(
-        outputs[0][inputs["input_ids"].shape[1]:],
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=True,
-    ).strip()
+    # Comments whose tokens would merge with the template take the full path
+    unsafe = [i for i, ids in enumerate(token_ids) if ids is None]
+    if unsafe:
+        for i, ids in zip(unsafe, render_token_ids([entries[i] for i in unsafe])):
+            token_ids[i] = ids
+    return token_ids
+
+
+def verify_prompt_assembly(entries):
+    """Fail unless spliced token ids match the full template path on ``entries``."""
+    mismatch = first_mismatch(tokenize_entries(entries), render_token_ids(entries))
+    if mismatch is not None:
+        raise ValueError(
+            f"Pre-tokenized prompt for {entries[mismatch]['comment_id']} differs from the "
+            "chat template path; set PRETOKENIZED_PROMPTS = False"
+        )
+    print(f"Pre-tokenized prompts match the chat template path on {len(entries)} samples")
+
+
+def collate_batch(token_ids):
+    """Pad pre-tokenized entries into keyword arguments for generate()."""
+    if not USE_PREFIX_CACHE:
+        # Left padding keeps every prompt flush against the first generated position
+        return tokenizer.pad({"input_ids": token_ids}, return_tensors="pt").to(DEVICE)
+
+    prefix = get_prompt_prefix()
+    inputs = splice_prefix(prefix["input_ids"], token_ids)
+    inputs["past_key_values"] = expand_prefix_cache(
+        prefix["past_key_values"], len(token_ids)
+    )
+    return inputs
+
 
+def parse_output(entry, text_output):
     # Handle possible markdown/code formatting
     if text_output.startswith("```"):
         text_output = text_output.strip("`")
@@ -237,31 +481,625 @@ def analyze(entry):
         print(f"\nSample {entry['comment_id']}: Failed to parse JSON")
         print(f"Gold score: {gold_score:>6} | Generated: N/A")
     else:
-        generated_score = prediction.get("overall", {}).get("score", "N/A")
+        generated_score = prediction.get("overall", {}).get("score", prediction.get("s", "N/A"))
         print(f"\nSample {entry['comment_id']}:")
         print(f"Gold score: {gold_score:>6} | Generated: {generated_score:>6}")
 
     return {"id": entry["comment_id"], "prediction": prediction}
 
+
+_value_vocabulary = None
+_schema_decoder = None
+_likelihood_scorer = None
+
+
+def get_value_vocabulary():
+    """Scan the tokenizer vocabulary for value tokens once per model."""
+    global _value_vocabulary
+    if _value_vocabulary is None:
+        _value_vocabulary = ValueVocabulary(tokenizer)
+    return _value_vocabulary
+
+
+def get_schema_decoder():
+    global _schema_decoder
+    if RESPONSE_FORMAT != "full":
+        raise ValueError('Schema-forced decoding writes the full schema; set RESPONSE_FORMAT = "full"')
+    if _schema_decoder is None:
+        vocabulary = get_value_vocabulary() if CONSTRAIN_VALUES else None
+        _schema_decoder = SchemaForcedDecoder(
+            model,
+            tokenizer,
+            vocabulary=vocabulary,
+            skip_below=CONDITIONAL_THRESHOLD,
+            skip_sections=CONDITIONAL_SECTIONS,
+        )
+    return _schema_decoder
+
+
+def get_likelihood_scorer():
+    global _likelihood_scorer
+    if RESPONSE_FORMAT != "full":
+        raise ValueError('Likelihood scoring fills the full schema; set RESPONSE_FORMAT = "full"')
+    if _likelihood_scorer is None:
+        _likelihood_scorer = SchemaLikelihoodScorer(model, tokenizer, get_value_vocabulary())
+    return _likelihood_scorer
+
+
+_continuous_batcher = None
+
+
+def get_continuous_batcher():
+    global _continuous_batcher
+    if DECODING_MODE != "generate" or PARALLEL_FIELD_GROUPS or PROMPT_LOOKUP_NUM_TOKENS:
+        raise ValueError(
+            "Continuous batching runs plain generate mode; turn off PARALLEL_FIELD_GROUPS "
+            "and PROMPT_LOOKUP_NUM_TOKENS"
+        )
+    if _continuous_batcher is None:
+        def make_processor():
+            # Each row gets its own processor, fed only that row's output
+            return SchemaLogitsProcessor(tokenizer, get_value_vocabulary(), 0)
+
+        _continuous_batcher = ContinuousBatcher(
+            model,
+            tokenizer,
+            max_slots=MAX_BATCH_SIZE,
+            max_new_tokens=MAX_NEW_TOKENS,
+            stop_on_json_close=STOP_ON_JSON_CLOSE,
+            make_processor=make_processor if CONSTRAIN_VALUES else None,
+            prefix_cache=get_prompt_prefix()["past_key_values"] if USE_PREFIX_CACHE else None,
+        )
+    return _continuous_batcher
+
+
+_prediction_cache = None
+
+
+def get_prediction_cache():
+    """Open the shared prediction cache under the current configuration.
+
+    Everything that decides a prediction goes into the key: the model, the
+    rendered prompt template (chat template and RESPONSE_FORMAT included)
+    and the decoding settings. Batching and prefix caching do not.
+    """
+    global _prediction_cache
+    if _prediction_cache is None:
+        namespace = {
+            **model_fingerprint(MODEL_NAME),
+            "backend": BACKEND,
+            "dtype": str(model.dtype),
+            "prompt": build_prompt({"text": "{text}"}),
+            "decoding": {
+                "mode": DECODING_MODE,
+                "do_sample": False,
+                "max_new_tokens": MAX_NEW_TOKENS,
+                "stop_on_json_close": STOP_ON_JSON_CLOSE,
+                "parallel_field_groups": PARALLEL_FIELD_GROUPS,
+                "constrain_values": CONSTRAIN_VALUES,
+                "conditional_threshold": CONDITIONAL_THRESHOLD,
+                "conditional_sections": list(CONDITIONAL_SECTIONS),
+            },
+        }
+        _prediction_cache = PredictionCache(namespace, PREDICTION_CACHE_PATH)
+    return _prediction_cache
+
+
+def lookup_cached(entries):
+    """Results for the entries the prediction cache already holds, by index."""
+    if not USE_PREDICTION_CACHE:
+        return {}
+    cached = get_prediction_cache().get_many([entry["text"] for entry in entries])
+    return {
+        i: {"id": entries[i]["comment_id"], "prediction": prediction}
+        for i, prediction in cached.items()
+    }
+
+
+def analyze_batch(entries, token_ids=None):
+    """Predict a chunk of entries, running the model only on cache misses.
+
+    ``token_ids`` can carry the output of tokenize_entries() for these
+    entries so they are not tokenized twice. Results come back in the same
+    order as ``entries``.
+    """
+    results = lookup_cached(entries)
+    misses = [i for i in range(len(entries)) if i not in results]
+    if misses:
+        generated = generate_batch(
+            [entries[i] for i in misses],
+            None if token_ids is None else [token_ids[i] for i in misses],
+        )
+        if USE_PREDICTION_CACHE:
+            get_prediction_cache().put_many(
+                (entries[i]["text"], result["prediction"])
+                for i, result in zip(misses, generated)
+            )
+        results.update(zip(misses, generated))
+    return [results[i] for i in range(len(entries))]
+
+
+def field_group_seeds():
+    """(section, opening text) per schema section, laid out as in SYSTEM_PROMPT."""
+    sections = dict.fromkeys(section for section, _, _ in schema_fields())
+    return [(section, f'{{\n  "{section}": {{\n') for section in sections]
+
+
+def generate_field_groups(inputs):
+    """Decode every schema section of every entry as its own batch row.
+
+    Each prompt is prefilled once; its KV cache is then repeated into one
+    row per section, seeded with that section's opening text, so the
+    sections decode side by side instead of one after another. A row stops
+    when its section object closes. Returns the section texts per entry,
+    for stitch_field_groups().
+    """
+    if RESPONSE_FORMAT != "full":
+        raise ValueError('Field-group decoding writes the full schema; set RESPONSE_FORMAT = "full"')
+    if PROMPT_LOOKUP_NUM_TOKENS:
+        raise ValueError("Prompt lookup decodes one row at a time; turn off PARALLEL_FIELD_GROUPS")
+
+    groups = field_group_seeds()
+    input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+    past_key_values = inputs.get("past_key_values")
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    past_length = past_key_values.get_seq_length()
+
+    # Prefill the rest of each prompt once, before the cache is copied
+    position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+    with torch.no_grad():
+        model(
+            input_ids=input_ids[:, past_length:],
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, past_length:],
+            past_key_values=past_key_values,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+    past_key_values.batch_repeat_interleave(len(groups))
+
+    # Seeds go after masked padding so every copy of a prompt keeps the
+    # positions its cached keys and values were computed at
+    seed_ids = [tokenizer(seed, add_special_tokens=False)["input_ids"] for _, seed in groups]
+    width = max(len(ids) for ids in seed_ids)
+    rows, masks = [], []
+    for ids, mask in zip(input_ids.tolist(), attention_mask.tolist()):
+        for seed in seed_ids:
+            pad = width - len(seed)
+            rows.append(ids + [tokenizer.pad_token_id] * pad + seed)
+            masks.append(mask + [0] * pad + [1] * len(seed))
+    input_ids = torch.tensor(rows, device=DEVICE)
+    attention_mask = torch.tensor(masks, device=DEVICE)
+    prompt_length = input_ids.shape[1]
+
+    stopping_criteria = StoppingCriteriaList()
+    if STOP_ON_JSON_CLOSE:
+        # Each row starts inside its section object and ends when it closes
+        stopping_criteria.append(
+            JsonObjectStoppingCriteria(tokenizer, prompt_length, initial_depth=1)
+        )
+
+    logits_processor = LogitsProcessorList()
+    if CONSTRAIN_VALUES:
+        logits_processor.append(
+            SchemaLogitsProcessor(tokenizer, get_value_vocabulary(), prompt_length)
+        )
+
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=stopping_criteria,
+            logits_processor=logits_processor,
+        )
+
+    texts = tokenizer.batch_decode(
+        outputs[:, prompt_length:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=True,
+    )
+    return [texts[start : start + len(groups)] for start in range(0, len(texts), len(groups))]
+
+
+def cut_section(text_output):
+    """A section's text up to the brace that closes it.
+
+    Generation stops on the whole token that closes the section, which is
+    usually "}," since another key would follow; the comma would leave the
+    stitched object invalid.
+    """
+    tracker = JsonBraceTracker(depth=1)
+    for end, ch in enumerate(text_output, start=1):
+        if tracker.feed(ch):
+            return text_output[:end]
+    return text_output
+
+
+def stitch_field_groups(entry, section_texts):
+    """Parse one entry's section texts back into a single prediction."""
+    prediction = {}
+    for (section, seed), text_output in zip(field_group_seeds(), section_texts):
+        # Close the outer object the seed opened
+        parsed = extract_json(seed + cut_section(text_output) + "\n}")
+        if parsed is not None and isinstance(parsed.get(section), dict):
+            prediction[section] = parsed[section]
+        else:
+            print(f"Failed to parse the {section} section for {entry['comment_id']}")
+    print(json.dumps(prediction))
+    return {"id": entry["comment_id"], "prediction": prediction or None}
+
+
+def generate_batch(entries, token_ids=None):
+    """Run one padded generate (or schema-forced decode or scoring) call for a chunk."""
+    if token_ids is None:
+        token_ids = tokenize_entries(entries)
+
+    if PROMPT_LOOKUP_NUM_TOKENS and DECODING_MODE == "generate" and len(entries) > 1:
+        # transformers only runs assisted generation on a single row
+        return [
+            result
+            for entry, ids in zip(entries, token_ids)
+            for result in generate_batch([entry], [ids])
+        ]
+
+    raw_outputs = generate_raw(collate_batch(token_ids))
+    return [parse_raw(entry, raw) for entry, raw in zip(entries, raw_outputs)]
+
+
+def generate_raw(inputs):
+    """Run the model on collated inputs; one unparsed output per row.
+
+    That is the generated text, or the section texts with
+    PARALLEL_FIELD_GROUPS. parse_raw() turns it into a result.
+    """
+    if DECODING_MODE == "schema":
+        return get_schema_decoder().decode(inputs)
+    if DECODING_MODE == "score":
+        return get_likelihood_scorer().score(inputs)
+    if PARALLEL_FIELD_GROUPS:
+        return generate_field_groups(inputs)
+
+    prompt_length = inputs["input_ids"].shape[1]
+
+    stopping_criteria = StoppingCriteriaList()
+    if STOP_ON_JSON_CLOSE:
+        stopping_criteria.append(JsonObjectStoppingCriteria(tokenizer, prompt_length))
+
+    logits_processor = LogitsProcessorList()
+    if CONSTRAIN_VALUES:
+        logits_processor.append(
+            SchemaLogitsProcessor(tokenizer, get_value_vocabulary(), prompt_length)
+        )
+
+    assisted = {}
+    if PROMPT_LOOKUP_NUM_TOKENS:
+        # Most of the output copies key names and punctuation from the schema
+        # in the prompt. Drafts are taken from matching prompt n-grams and
+        # checked in one forward pass, so the greedy output does not change.
+        assisted["prompt_lookup_num_tokens"] = PROMPT_LOOKUP_NUM_TOKENS
+
+    with torch.no_grad():
+        outputs = model.generate(
+            **inputs,
+            **assisted,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=stopping_criteria,
+            logits_processor=logits_processor,
+        )
+
+    texts = tokenizer.batch_decode(
+        outputs[:, prompt_length:],
+        skip_special_tokens=True,
+        clean_up_tokenization_spaces=True,
+    )
+    return [text.strip() for text in texts]
+
+
+def parse_raw(entry, raw):
+    """Turn one generate_raw() output into a result record."""
+    if PARALLEL_FIELD_GROUPS and DECODING_MODE == "generate":
+        return stitch_field_groups(entry, raw)
+    return parse_output(entry, raw)
+
+
+def generate_continuous(entries):
+    """Yield a result per entry as the continuous batcher finishes it.
+
+    Results come in completion order; each one is stored in the prediction
+    cache as it arrives.
+    """
+    token_ids = tokenize_entries(entries)
+    for index, output_ids in get_continuous_batcher().run(enumerate(token_ids)):
+        text_output = tokenizer.decode(
+            output_ids,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True,
+        ).strip()
+        result = parse_output(entries[index], text_output)
+        if USE_PREDICTION_CACHE:
+            get_prediction_cache().put_many([(entries[index]["text"], result["prediction"])])
+        yield result
+
+
+def analyze(entry):
+    return analyze_batch([entry])[0]
+
 # --------------------------
 # Run Inference
 # --------------------------
-def run_inference(entries):
-    results = []
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        for i in tqdm(range(0, len(entries), BATCH_SIZE), desc="Running inference"):
-            batch = entries[i : i + BATCH_SIZE]
-            for entry in batch:
-                result = analyze(entry)
-                results.append(result)
-                f.write(json.dumps(result) + "\n")
-                f.flush()  # Ensure writes in case of interruption
+def schedule_batches(entries):
+    """Pre-tokenize all entries and plan the batches to run them in.
+
+    Returns the token ids per entry and a list of index batches. With
+    TOKEN_BUDGET set, entries are bucketed by length; otherwise they are cut
+    into fixed BATCH_SIZE chunks. Either way the padding ratio is reported.
+    """
+    token_ids = tokenize_entries(entries)
+    lengths = [len(ids) for ids in token_ids]
+    fixed = fixed_batches(len(entries), BATCH_SIZE)
+
+    if TOKEN_BUDGET is None:
+        batches = fixed
+        print(f"Padding ratio: {padding_ratio(lengths, batches):.1%} (fixed BATCH_SIZE={BATCH_SIZE})")
+    else:
+        batches = plan_batches(lengths, TOKEN_BUDGET, MAX_BATCH_SIZE)
+        print(
+            f"Padding ratio: {padding_ratio(lengths, batches):.1%} over {len(batches)} "
+            f"length-bucketed batches (fixed BATCH_SIZE={BATCH_SIZE} would be "
+            f"{padding_ratio(lengths, fixed):.1%})"
+        )
+    return token_ids, batches
+
+
+def load_completed(path):
+    """Collect the ids already written to an output file.
+
+    An interrupted run can leave a torn last line; it is cut off so the next
+    append starts on a clean line. Damage anywhere else is an error.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+
+    with open(path, "rb+") as f:
+        lines = f.readlines()
+        good_bytes = 0
+        for line_num, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if record is None or not line.endswith(b"\n"):
+                if line_num < len(lines):
+                    raise ValueError(f"Corrupt record on line {line_num} of {path}")
+                print(f"Dropping torn last line of {path}")
+                break
+            completed.add(record["id"])
+            good_bytes += len(line)
+        f.truncate(good_bytes)
+    return completed
+
+
+def append_batch(f, batch_results):
+    """Append one batch with a single write and force it to disk."""
+    f.write("".join(json.dumps(result) + "\n" for result in batch_results))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def finalize_output(entries):
+    """Rewrite OUTPUT_FILE in input order and return the results.
+
+    Batches are appended in the order they finish, so the file is sorted
+    back into the order of ``entries`` (records for other ids are kept at
+    the end) and swapped in atomically.
+    """
+    records = {}
+    with open(OUTPUT_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            records[record["id"]] = record
+
+    results = [records[entry["comment_id"]] for entry in entries]
+    wanted = {entry["comment_id"] for entry in entries}
+    others = [record for record_id, record in records.items() if record_id not in wanted]
+    tmp_path = OUTPUT_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for result in results + others:
+            f.write(json.dumps(result) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, OUTPUT_FILE)
     return results
 
+
+def run_pipelined(entries, f):
+    """Run the static batches through StagedPipeline, appending to ``f``.
+
+    The model thread only generates: the batches are tokenized and collated,
+    parsed, cached and written on the other stages' threads.
+    """
+    token_ids = None
+    if TOKEN_BUDGET is not None and not PROMPT_LOOKUP_NUM_TOKENS:
+        # Length bucketing needs every token count up front
+        token_ids, batches = schedule_batches(entries)
+    else:
+        # Prompt lookup decodes one row at a time anyway
+        batches = fixed_batches(len(entries), 1 if PROMPT_LOOKUP_NUM_TOKENS else BATCH_SIZE)
+
+    def prepare(batch):
+        batch_entries = [entries[i] for i in batch]
+        if token_ids is None:
+            batch_ids = tokenize_entries(batch_entries)
+        else:
+            batch_ids = [token_ids[i] for i in batch]
+        return batch_entries, collate_batch(batch_ids)
+
+    def run_model(prepared):
+        batch_entries, inputs = prepared
+        return batch_entries, generate_raw(inputs)
+
+    def parse(generated):
+        batch_entries, raw_outputs = generated
+        return [parse_raw(entry, raw) for entry, raw in zip(batch_entries, raw_outputs)]
+
+    def write(batch_results):
+        if USE_PREDICTION_CACHE:
+            get_prediction_cache().put_many(
+                (texts[result["id"]], result["prediction"]) for result in batch_results
+            )
+        append_batch(f, batch_results)
+
+    texts = {entry["comment_id"]: entry["text"] for entry in entries}
+    pipeline = StagedPipeline(
+        prepare,
+        run_model,
+        parse,
+        write,
+        parse_workers=PARSE_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+    )
+    with tqdm(total=len(batches), desc="Running inference") as progress:
+        pipeline.run(batches, progress)
+    print("\n".join(pipeline.report()))
+
+
+def run_inference(entries):
+    if RESUME:
+        completed = load_completed(OUTPUT_FILE)
+    else:
+        completed = set()
+        open(OUTPUT_FILE, "w", encoding="utf-8").close()
+
+    pending = [entry for entry in entries if entry["comment_id"] not in completed]
+    if len(pending) < len(entries):
+        print(f"Resuming: {len(entries) - len(pending)} of {len(entries)} samples already done")
+
+    cached = lookup_cached(pending)
+    if cached:
+        # Hits go straight to the output; only misses are tokenized and batched
+        print(f"Prediction cache: {len(cached)} of {len(pending)} samples already predicted")
+        with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
+            append_batch(f, [cached[i] for i in sorted(cached)])
+        pending = [entry for i, entry in enumerate(pending) if i not in cached]
+
+    if pending and PRETOKENIZED_PROMPTS and VERIFY_PROMPT_SAMPLES:
+        verify_prompt_assembly(pending[:VERIFY_PROMPT_SAMPLES])
+
+    if pending and CONTINUOUS_BATCHING:
+        with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
+            for result in tqdm(
+                generate_continuous(pending), total=len(pending), desc="Running inference"
+            ):
+                append_batch(f, [result])
+    elif pending and PIPELINED:
+        with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
+            run_pipelined(pending, f)
+    elif pending:
+        token_ids, batches = schedule_batches(pending)
+        with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
+            for batch in tqdm(batches, desc="Running inference"):
+                batch_results = analyze_batch(
+                    [pending[i] for i in batch], [token_ids[i] for i in batch]
+                )
+                append_batch(f, batch_results)
+
+    return finalize_output(entries)
+
+
+# --------------------------
+# CPU Worker Processes
+# --------------------------
+def run_shard(shard, output_file, num_threads):
+    """--workers entry point: run one shard into its own output file."""
+    global OUTPUT_FILE, _prediction_cache
+    torch.set_num_threads(num_threads)
+    _prediction_cache = None  # A forked worker must not reuse the parent's SQLite connection
+    OUTPUT_FILE = output_file
+    run_inference(shard)
+
+
+def time_shard(shard, num_threads):
+    """Autotune entry point: seconds to predict ``shard``, prediction cache off."""
+    global USE_PREDICTION_CACHE
+    torch.set_num_threads(num_threads)
+    USE_PREDICTION_CACHE = False
+    token_ids, batches = schedule_batches(shard)
+    start = time.perf_counter()
+    for batch in batches:
+        generate_batch([shard[i] for i in batch], [token_ids[i] for i in batch])
+    return time.perf_counter() - start
+
+
+def run_inference_sharded(entries, workers, num_threads, start_method="spawn"):
+    """Split the pending entries across CPU worker processes, merge in order."""
+    if RESUME:
+        completed = load_completed(OUTPUT_FILE)
+    else:
+        completed = set()
+        open(OUTPUT_FILE, "w", encoding="utf-8").close()
+
+    pending = [entry for entry in entries if entry["comment_id"] not in completed]
+    if pending:
+        run_sharded(run_shard, pending, workers, num_threads, OUTPUT_FILE, start_method)
+    return finalize_output(entries)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the local baseline over TEST_FILE")
+    parser.add_argument(
+        "--workers",
+        default="1",
+        help='CPU worker processes, each running one shard, or "auto" to autotune',
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="torch threads per worker (default: cores / workers)"
+    )
+    parser.add_argument(
+        "--share-weights",
+        action="store_true",
+        help="fork the workers after the model is loaded so they share its weights copy-on-write",
+    )
+    args = parser.parse_args()
+    if args.workers != "auto" and not (args.workers.isdigit() and int(args.workers) >= 1):
+        parser.error('--workers must be a positive integer or "auto"')
+    if args.workers != "1" and DEVICE != "cpu":
+        parser.error("--workers shards CPU inference; run on one process with a GPU")
+    return args
+
+
+def run_with_args(entries, args):
+    # The model is already loaded at import; forking shares it instead of
+    # having every spawned worker load its own copy
+    start_method = "fork" if args.share_weights else "spawn"
+    if args.workers == "auto":
+        workers, num_threads = autotune(
+            time_shard, entries[:AUTOTUNE_SAMPLES], start_method=start_method
+        )
+    else:
+        workers = int(args.workers)
+        num_threads = args.threads or max(1, available_cores() // workers)
+
+    if workers == 1:
+        torch.set_num_threads(num_threads)
+        return run_inference(entries)
+    return run_inference_sharded(entries, workers, num_threads, start_method)
+
+
 # --------------------------
 # Main
 # --------------------------
 if __name__ == "__main__":
+    args = parse_args()
     test_data = load_data(TEST_FILE)
     print(f"Loaded {len(test_data)} test samples")
     
@@ -270,5 +1108,5 @@ if __name__ == "__main__":
         test_data = test_data[:SAMPLE_LIMIT]
         print(f"Processing first {len(test_data)} samples (SAMPLE_LIMIT={SAMPLE_LIMIT})")
     
-    run_inference(test_data)
+    run_with_args(test_data, args)
     print(f"Inference complete. Results written to {OUTPUT_FILE}")
@@ -0,0 +1,79 @@
+"""Stop generation as soon as the top-level JSON object has closed."""
+import torch
+from transformers import StoppingCriteria
+
+
+class JsonBraceTracker:
+    """Follow brace depth and string state of JSON text fed in pieces.
+
+    Braces inside string literals (including escaped quotes) are ignored, as
+    is anything before the first ``{``, so markdown fences or a short
+    preamble do not confuse it.
+    """
+
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.started = depth > 0
+        self.in_string = False
+        self.escaped = False
+        self.closed = False
+
+    def feed(self, text):
+        """Consume more text; return True once the outermost object has closed."""
+        for ch in text:
+            if self.closed:
+                break
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == "{":
+                self.depth += 1
+                self.started = True
+            elif not self.started:
+                continue
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+        return self.closed
+
+
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    """Finish each batch row independently when its JSON object closes.
+
+    Only the tokens added since the previous call are decoded, so the cost
+    per step does not grow with the output length. ``initial_depth`` lets a
+    row start inside an already opened object.
+    """
+
+    def __init__(self, tokenizer, prompt_length, initial_depth=0):
+        self.tokenizer = tokenizer
+        self.seen = prompt_length
+        self.initial_depth = initial_depth
+        self.trackers = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.trackers is None:
+            self.trackers = [
+                JsonBraceTracker(self.initial_depth) for _ in range(input_ids.shape[0])
+            ]
+
+        new_tokens = input_ids[:, self.seen:].tolist()
+        self.seen = input_ids.shape[1]
+        for tracker, tokens in zip(self.trackers, new_tokens):
+            for token_id in tokens:
+                if tracker.closed:
+                    break
+                tracker.feed(self.tokenizer.decode([token_id], skip_special_tokens=True))
+
+        return torch.tensor(
+            [tracker.closed for tracker in self.trackers],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
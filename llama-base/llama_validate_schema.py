@@ -1,13 +1,72 @@
 import json, os
 
 # ========== CONFIG ==========
-# Create output directory
-os.makedirs("./llama_outputs", exist_ok=True)
-
 INPUT_FILE = "./llama_outputs/llama_baseline_outputs.jsonl"
 OUTPUT_FILE = "./llama_outputs/llama_baseline_outputs_validated.jsonl"
 # =============================
 
+FACETS_SCHEMA = [
+    "sentiment",
+    "respect",
+    "insult",
+    "humiliate",
+    "status",
+    "dehumanize",
+    "violence",
+    "genocide",
+    "attack_defend",
+    "hatespeech",
+]
+
+TARGETS_SCHEMA = [
+    "target_race_asian",
+    "target_race_black",
+    "target_race_latinx",
+    "target_race_middle_eastern",
+    "target_race_native_american",
+    "target_race_pacific_islander",
+    "target_race_white",
+    "target_race_other",
+    "target_religion_atheist",
+    "target_religion_buddhist",
+    "target_religion_christian",
+    "target_religion_hindu",
+    "target_religion_jewish",
+    "target_religion_mormon",
+    "target_religion_muslim",
+    "target_religion_other",
+    "target_origin_immigrant",
+    "target_origin_migrant_worker",
+    "target_origin_specific_country",
+    "target_origin_undocumented",
+    "target_origin_other",
+    "target_gender_men",
+    "target_gender_non_binary",
+    "target_gender_transgender_men",
+    "target_gender_transgender_unspecified",
+    "target_gender_transgender_women",
+    "target_gender_women",
+    "target_gender_other",
+    "target_sexuality_bisexual",
+    "target_sexuality_gay",
+    "target_sexuality_lesbian",
+    "target_sexuality_straight",
+    "target_sexuality_other",
+    "target_age_children",
+    "target_age_teenagers",
+    "target_age_young_adults",
+    "target_age_middle_aged",
+    "target_age_seniors",
+    "target_age_other",
+    "target_disability_physical",
+    "target_disability_cognitive",
+    "target_disability_neurological",
+    "target_disability_visually_impaired",
+    "target_disability_hearing_impaired",
+    "target_disability_unspecific",
+    "target_disability_other",
+]
+
 
 def clamp_int(value, min_val=0, max_val=4):
     """Round floats, clamp to range [0, 4], and ensure integer."""
@@ -18,11 +77,51 @@ def clamp_int(value, min_val=0, max_val=4):
     return max(min_val, min(max_val, int(value)))
 
 
+def is_compact(pred):
+    """Whether a prediction uses the compact {"s", "f", "t"} response format."""
+    return "facets" not in pred and any(key in pred for key in ("s", "f", "t"))
+
+
+def expand_compact(pred):
+    """Expand a compact response into the canonical nested schema.
+
+    Compact responses look like ``{"s": 1.47, "f": [4, 3, ...], "t": ["race_black"]}``:
+    the score, the facets as a list in FACETS_SCHEMA order, and only the
+    targets that are true, without their ``target_`` prefix.
+    """
+    try:
+        score = float(pred.get("s", 0.0))
+    except Exception:
+        score = 0.0
+
+    facets = pred.get("f")
+    if not isinstance(facets, list):
+        facets = []
+
+    true_targets = pred.get("t")
+    if not isinstance(true_targets, list):
+        true_targets = []
+    true_targets = {
+        name if name.startswith("target_") else f"target_{name}"
+        for name in true_targets
+        if isinstance(name, str)
+    }
+
+    return {
+        "overall": {"score": score},
+        "facets": dict(zip(FACETS_SCHEMA, facets)),
+        "targets": {key: key in true_targets for key in TARGETS_SCHEMA},
+    }
+
+
 def validate_schema(entry):
     """Validate one prediction entry."""
     if "prediction" not in entry or entry["prediction"] is None:
         return entry
 
+    if is_compact(entry["prediction"]):
+        entry["prediction"] = expand_compact(entry["prediction"])
+
     pred = entry["prediction"]
 
     # ========== OVERALL ==========
@@ -38,77 +137,17 @@ def validate_schema(entry):
     pred["overall"] = overall
 
     # ========== FACETS ==========
-    facets_schema = [
-        "sentiment",
-        "respect",
-        "insult",
-        "humiliate",
-        "status",
-        "dehumanize",
-        "violence",
-        "genocide",
-        "attack_defend",
-        "hatespeech",
-    ]
     facets = pred.get("facets", {})
     validated_facets = {}
-    for key in facets_schema:
+    for key in FACETS_SCHEMA:
         validated_facets[key] = clamp_int(facets.get(key, 0))
     pred["facets"] = validated_facets
 
     # ========== TARGETS ==========
     # All targets default to False
-    targets_schema = [
-        "target_race_asian",
-        "target_race_black",
-        "target_race_latinx",
-        "target_race_middle_eastern",
-        "target_race_native_american",
-        "target_race_pacific_islander",
-        "target_race_white",
-        "target_race_other",
-        "target_religion_atheist",
-        "target_religion_buddhist",
-        "target_religion_christian",
-        "target_religion_hindu",
-        "target_religion_jewish",
-        "target_religion_mormon",
-        "target_religion_muslim",
-        "target_religion_other",
-        "target_origin_immigrant",
-        "target_origin_migrant_worker",
-        "target_origin_specific_country",
-        "target_origin_undocumented",
-        "target_origin_other",
-        "target_gender_men",
-        "target_gender_non_binary",
-        "target_gender_transgender_men",
-        "target_gender_transgender_unspecified",
-        "target_gender_transgender_women",
-        "target_gender_women",
-        "target_gender_other",
-        "target_sexuality_bisexual",
-        "target_sexuality_gay",
-        "target_sexuality_lesbian",
-        "target_sexuality_straight",
-        "target_sexuality_other",
-        "target_age_children",
-        "target_age_teenagers",
-        "target_age_young_adults",
-        "target_age_middle_aged",
-        "target_age_seniors",
-        "target_age_other",
-        "target_disability_physical",
-        "target_disability_cognitive",
-        "target_disability_neurological",
-        "target_disability_visually_impaired",
-        "target_disability_hearing_impaired",
-        "target_disability_unspecific",
-        "target_disability_other",
-    ]
     targets = pred.get("targets", {})
     validated_targets = {}
-    for key in targets_schema:
+    for key in TARGETS_SCHEMA:
         val = targets.get(key, False)
         validated_targets[key] = bool(val) if isinstance(val, bool) else False
     pred["targets"] = validated_targets
@@ -136,4 +175,6 @@ def validate_file(input_path, output_path):
 
 
 if __name__ == "__main__":
+    # Create output directory
+    os.makedirs("./llama_outputs", exist_ok=True)
     validate_file(INPUT_FILE, OUTPUT_FILE)
@@ -0,0 +1,116 @@
+"""Load test for serve.py: many concurrent keep-alive clients, then a report.
+
+    python serve.py --backend gemma --no-cache &
+    python load_generator.py --concurrency 32 --requests 500
+
+Each of --concurrency clients holds one keep-alive connection and sends
+POST /moderate requests back to back with comments from --data (or
+synthetic ones) until --requests have been sent in total. The report has
+client-side throughput and p50/p99 latency, followed by the server's
+own /metrics (batch size histogram, queue depth, latency).
+
+Start the server with --no-cache: the texts repeat, and with the
+prediction cache on nearly every request after warm-up would be a cache
+hit, so the numbers would measure SQLite lookups rather than the model.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+DATA_FILE = "./data/test.jsonl"
+
+
+def load_texts(path, limit=10000):
+    if not path or not os.path.exists(path):
+        words = ["people", "like", "them", "should", "never", "always", "be", "welcome", "here", "gone"]
+        return [" ".join(random.choices(words, k=random.randint(5, 40))) for _ in range(100)]
+    texts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            texts.append(json.loads(line)["text"])
+            if len(texts) >= limit:
+                break
+    return texts
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def request(reader, writer, host, method, path, payload=None):
+    """One HTTP/1.1 request on an open keep-alive connection; returns (status, json)."""
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("latin-1")
+        + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(host, port, texts, counter, total, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while counter["sent"] < total:
+            counter["sent"] += 1
+            start = time.perf_counter()
+            status, _ = await request(
+                reader, writer, host, "POST", "/moderate", {"text": random.choice(texts)}
+            )
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(host, port, concurrency, total, texts):
+    counter, latencies, errors = {"sent": 0}, [], []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[client(host, port, texts, counter, total, latencies, errors) for _ in range(concurrency)]
+    )
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(latencies)} ok, {len(errors)} errors in {elapsed:.1f}s ({len(latencies) / elapsed:.2f} req/s)")
+    if latencies:
+        print(
+            f"Client latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.0f} ms"
+        )
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await request(reader, writer, host, "GET", "/metrics")
+    writer.close()
+    print("Server metrics:")
+    print(json.dumps(metrics, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for serve.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--data", default=DATA_FILE, help="JSONL with a \"text\" field; synthetic if missing")
+    args = parser.parse_args()
+    asyncio.run(run(args.host, args.port, args.concurrency, args.requests, load_texts(args.data)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Stream comments through a moderation backend: JSONL or text in, JSONL out.
+
+    python moderate.py comments.jsonl --backend gemma > predictions.jsonl
+    cat comments.txt | python moderate.py --backend gemini --format text
+
+Input is read lazily, --chunk-size comments at a time. Each chunk is
+predicted, validated and written to stdout before the next one is read,
+so memory stays flat however long the input is. JSONL lines need a
+"text" and may carry a "comment_id" (or "id"); plain-text lines are one
+comment each, numbered by line. Anything the backends print goes to
+stderr, so stdout holds only predictions.
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import sys
+
+from backends import BACKENDS, load_backend
+
+CHUNK_SIZE = 256
+
+
+def read_entries(stream, input_format="auto"):
+    """Yield {"comment_id", "text"} entries from JSONL or plain-text lines."""
+    for line_num, line in enumerate(stream, start=1):
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        if input_format != "text":
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = None
+            if isinstance(record, dict) and isinstance(record.get("text"), str):
+                comment_id = record.get("comment_id", record.get("id", line_num))
+                yield {"comment_id": comment_id, "text": record["text"]}
+                continue
+            if input_format == "jsonl":
+                print(f"Skipping line {line_num}: no \"text\" field", file=sys.stderr)
+                continue
+        yield {"comment_id": line_num, "text": line}
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a stream of comments")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL or text file; - for stdin")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="gemma")
+    parser.add_argument("--format", choices=["auto", "jsonl", "text"], default="auto")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    out = sys.stdout
+    stream = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+    total = 0
+    with stream, contextlib.redirect_stdout(sys.stderr):
+        backend = load_backend(args.backend)
+        try:
+            for chunk in chunked(read_entries(stream, args.format), args.chunk_size):
+                for result in backend.predict(chunk):
+                    out.write(json.dumps(backend.validate(result)) + "\n")
+                out.flush()
+                total += len(chunk)
+                print(f"Scored {total} comments")
+        finally:
+            backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Long-lived moderation service that micro-batches concurrent requests.
+
+    python serve.py --backend gemma --port 8000 --max-batch-size 16 --max-wait-ms 20
+    curl -s localhost:8000/moderate -d '{"text": "some comment"}'
+    curl -s localhost:8000/metrics
+
+The model stays loaded between requests. Requests that arrive while the
+model is busy (or within --max-wait-ms of the first one) are gathered into
+one batch of up to --max-batch-size and predicted together on a single
+worker thread, so the event loop keeps accepting connections meanwhile.
+Every response is the validated schema for that request's comment.
+
+Endpoints:
+- POST /moderate  {"text": ..., "comment_id": optional} -> {"id", "prediction"}
+- GET /metrics    queue depth, batch size histogram, p50/p99 latency
+- GET /health
+
+Plain asyncio streams with a minimal HTTP/1.1 keep-alive parser, so
+nothing beyond the backend's own dependencies is needed.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from backends import BACKENDS, load_backend
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+LATENCY_WINDOW = 10000  # Most recent request latencies kept for the percentiles
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class MicroBatcher:
+    """Collect submitted entries into batches for a blocking ``predict(entries)``.
+
+    A batch closes when it reaches ``max_batch_size`` or ``max_wait_ms``
+    after its first entry arrived, whichever comes first.
+    """
+
+    def __init__(self, predict, max_batch_size=16, max_wait_ms=20):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)  # The model runs one batch at a time
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.completed = 0
+        self.failed = 0
+
+    async def submit(self, entry):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entry, future, time.perf_counter()))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                # Requests that queued up while the model was busy
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            self.batch_sizes[len(batch)] += 1
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict, [entry for entry, _, _ in batch]
+                )
+            except Exception as exc:
+                self.failed += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+
+            now = time.perf_counter()
+            for (_, future, start), result in zip(batch, results):
+                self.latencies.append(now - start)
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+
+    def metrics(self):
+        latencies = list(self.latencies)
+        p50, p99 = percentile(latencies, 0.50), percentile(latencies, 0.99)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "batches": sum(self.batch_sizes.values()),
+            "batch_size_histogram": {str(size): n for size, n in sorted(self.batch_sizes.items())},
+            "latency_ms": {
+                "p50": None if p50 is None else round(p50 * 1000, 1),
+                "p99": None if p99 is None else round(p99 * 1000, 1),
+                "window": len(latencies),
+            },
+        }
+
+
+class ModerationServer:
+    """HTTP front end: parses requests and hands comments to the batcher."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def route(self, method, path, body):
+        path = path.split("?")[0]
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics()
+        if method != "POST" or path != "/moderate":
+            return 404, {"error": f"No route for {method} {path}"}
+
+        try:
+            request = json.loads(body)
+            text = request["text"]
+            if not isinstance(text, str):
+                raise TypeError("text must be a string")
+        except (ValueError, KeyError, TypeError) as exc:
+            return 400, {"error": f"Expected a JSON object with a \"text\" string ({exc})"}
+
+        # Backends match results by position in the batch, so ids may repeat
+        entry = {"comment_id": request.get("comment_id"), "text": text}
+        try:
+            result = await self.batcher.submit(entry)
+        except Exception as exc:
+            return 500, {"error": str(exc)}
+        return 200, {"id": result["id"], "prediction": result["prediction"]}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path, body)
+                data = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away or sent something that is not HTTP
+        finally:
+            writer.close()
+
+
+async def serve(backend_name, host, port, max_batch_size, max_wait_ms, use_cache=True):
+    backend = load_backend(backend_name, use_cache)
+
+    def predict(entries):
+        return [backend.validate(result) for result in backend.predict(entries)]
+
+    batcher = MicroBatcher(predict, max_batch_size, max_wait_ms)
+    server = await asyncio.start_server(ModerationServer(batcher).handle, host, port)
+    print(
+        f"Serving {backend_name} on http://{host}:{port} (batches of up to {max_batch_size}, "
+        f"{max_wait_ms} ms wait, prediction cache {'on' if use_cache else 'off'})"
+    )
+    batch_loop = asyncio.create_task(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_loop.cancel()
+        # Like predict(), close() may drive the backend's own event loop, which
+        # cannot run on this one's thread
+        await asyncio.get_running_loop().run_in_executor(batcher.executor, backend.close)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-batching moderation server")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="gemma")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="turn the prediction cache off, so load tests measure the model and not cache hits",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(
+            serve(
+                args.backend,
+                args.host,
+                args.port,
+                args.max_batch_size,
+                args.max_wait_ms,
+                use_cache=not args.no_cache,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()